@@ -0,0 +1,357 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+import picture_to_word as ptw
+from image_prepare import ImageCache
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+BENCHMARK_VERSION = 1
+# 各阶段的名称, 与结果文件中的顺序相同
+STAGES = [
+    "scan",  # 扫描图片目录, 解析文件名, 读取图片文件头
+    # 预处理图片: 缩放, 重新压缩, 去除exif信息; 流水线模式下是等待图片的时间
+    "exif_clean",
+    "template_expansion",  # 解析和分析模板, 按缺陷数量展开表格
+    "detail_fill",  # 生成明细表并插入图片
+    "summary_fill",  # 填写汇总表, 统计表和总览
+    "statistics",  # 缺陷类别 x 缺陷等级统计
+    "save",  # 保存文件
+]
+# 缺陷描述: 精确匹配, 关键字匹配和无法匹配的都有
+REASONS = [*list(ptw.bugMap)[:20], "导线断股异常", "横担锈蚀严重", "奇怪的东西"]
+LEVELS = list(ptw.bug_type_map.values())
+
+
+# 生成合成的缺陷图片: 线路_杆号_缺陷描述_等级.jpg, 部分带 _特写 图片
+def photo_names(count, close_up_ratio=0.1, seed=0):
+    """Yield the file names of count defects and their close-ups"""
+    rng = random.Random(seed)
+    for i in range(count):
+        reason, level = rng.choice(REASONS), rng.choice(LEVELS)
+        stem = f"10kV{100 + i // 50}线_#{i:04d}_{reason}_{level}"
+        yield f"{stem}.jpg"
+        if rng.random() < close_up_ratio:
+            yield f"{stem}_特写.jpg"
+
+
+def make_photo(path, size, seed):
+    """Write a distinct JPEG with camera EXIF data, like a photo from the field"""
+    rng = random.Random(seed)
+    img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    width, height = size
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        w, h = rng.randrange(width // 2 + 1), rng.randrange(height // 2 + 1)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle((x, y, x + w, y + h), fill=color)
+    draw.text((10, 10), str(seed), fill=(255, 255, 255))
+    exif = Image.Exif()
+    exif[0x010F] = "Benchmark"  # Make
+    exif[0x0110] = f"Camera {seed % 5}"  # Model
+    exif[0x0132] = "2024:01:01 12:00:00"  # DateTime
+    exif[0x010E] = "x" * 4096  # ImageDescription
+    img.save(path, "JPEG", quality=90, exif=exif)
+
+
+def generate_photos(image_dir, count, size, close_up_ratio=0.1, seed=0):
+    """Create the synthetic picture set in image_dir, reusing it if it is complete.
+
+    Returns the number of files.
+    """
+    settings = {
+        "count": count,
+        "size": list(size),
+        "close_ups": close_up_ratio,
+        "seed": seed,
+    }
+    settings_file = os.path.join(image_dir, "benchmark.json")
+    names = list(photo_names(count, close_up_ratio, seed))
+    if os.path.isfile(settings_file):
+        with open(settings_file, encoding="utf-8") as f:
+            if json.load(f) == settings:
+                return len(names)
+    os.makedirs(image_dir, exist_ok=True)
+    for i, name in enumerate(names):
+        make_photo(os.path.join(image_dir, name), size, seed * 1000003 + i)
+    # 最后写入参数, 生成中断时下次重新生成
+    with open(settings_file, "w", encoding="utf-8") as f:
+        json.dump(settings, f)
+    return len(names)
+
+
+# 报告生成器记录的阶段 -> 测试结果中的阶段, 都按不含嵌套阶段的耗时计算
+BUILDER_STAGES = {
+    "scan_images": "scan",
+    "get_images": "scan",
+    "prepare_images": "exif_clean",
+    # 流水线模式: 等待后台预处理图片的时间
+    "wait_prepared_image": "exif_clean",
+    # 模板缓存为空, 包括解析和分析模板的时间
+    "analyse_template": "template_expansion",
+    "get_template": "template_expansion",
+    "deal_one_type_table": "detail_fill",
+    "set_detail_statis": "summary_fill",
+    "bug_num_statis": "summary_fill",
+    "bug_type_statis": "summary_fill",
+    "set_total_description": "summary_fill",
+    "statistics": "statistics",
+    "save": "save",
+}
+
+
+def stage_times(instrumentation):
+    """Exclusive seconds of every benchmark stage, from the builder's stages"""
+    times = dict.fromkeys(STAGES, 0.0)
+    for name, (_, _, own) in instrumentation.stages.items():
+        if name in BUILDER_STAGES:
+            times[BUILDER_STAGES[name]] += own
+    return times
+
+
+# 进程的内存峰值(MB), 包括已经结束的子进程(图片预处理进程池)
+def peak_memory_mb():
+    if resource is None:
+        return None
+    # macOS 的单位是字节, Linux 是KB
+    unit = 1 << 20 if sys.platform == "darwin" else 1 << 10
+    peak = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        peak = max(peak, resource.getrusage(who).ru_maxrss)
+    return round(peak / unit, 1)
+
+
+def run_case(image_dir, template, work_dir, workers=0, options=None, trace_memory=False):
+    """Build one report from image_dir, returning its timings, memory and size.
+
+    options overrides picture_to_word settings, e.g. {"render_shards": 4}.
+    Runs in a fresh process (see run_cases), so the peak memory is that of this
+    report alone. The image and template caches start empty.
+    """
+    ptw.debug = ptw.warn = False
+    for name, value in (options or {}).items():
+        setattr(ptw, name, value)
+    if trace_memory:
+        import tracemalloc
+
+        tracemalloc.start()
+    with open(template, "rb") as f:
+        template_data = f.read()
+    output = os.path.join(work_dir, "report.docx")
+    builder = ptw.ReportBuilder(
+        image_dir,
+        template_data,
+        workers=workers,
+        cache=ptw.TemplateCache(),
+        image_cache=ImageCache(os.path.join(work_dir, "cache")),
+    )
+    start = time.perf_counter()
+    if not builder.scan(prepare=not ptw.pipeline_images):
+        raise RuntimeError(f"{image_dir} 中没有可用的图片")
+    builder.build(stream_to=output if ptw.stream_output else None)
+    builder.save(output)
+    total = time.perf_counter() - start
+    times = stage_times(builder.instrumentation)
+    result = {
+        "total": round(total, 4),
+        "stages": {name: round(seconds, 4) for name, seconds in times.items()},
+        "other": round(total - sum(times.values()), 4),
+        "peak_rss_mb": peak_memory_mb(),
+        "output_bytes": os.path.getsize(output),
+        "pictures": len(builder.records),
+        "defects": builder.statistics.count(),
+        "counters": dict(builder.instrumentation.counters),
+    }
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        result["peak_traced_mb"] = round(peak / (1 << 20), 1)
+        tracemalloc.stop()
+    return result
+
+
+def run_cases(
+    cases, template, data_dir, repeat=1, workers=0, options=None, trace_memory=False
+):
+    """Generate the picture sets and run every (count, size) case repeat times"""
+    # 每次运行使用新的进程, 互不影响内存峰值和缓存
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for count, size in cases:
+        image_dir = os.path.join(data_dir, f"{count}_{size[0]}x{size[1]}")
+        print(f"准备 {count} 个缺陷, {size[0]}x{size[1]} 的图片...", flush=True)
+        generate_photos(image_dir, count, size)
+        runs = []
+        for i in range(repeat):
+            with tempfile.TemporaryDirectory() as work_dir:
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    run = executor.submit(
+                        run_case,
+                        image_dir,
+                        template,
+                        work_dir,
+                        workers,
+                        options,
+                        trace_memory,
+                    ).result()
+            print(f"  第{i + 1}次: {run['total']:.2f}s", flush=True)
+            runs.append(run)
+        results.append(
+            {"count": count, "size": list(size), "runs": runs, "best": best_run(runs)}
+        )
+    return results
+
+
+def best_run(runs):
+    """The fastest run; the stage times are the minimum over all runs"""
+    best = dict(min(runs, key=lambda run: run["total"]))
+    best["stages"] = {name: min(run["stages"][name] for run in runs) for name in STAGES}
+    return best
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def case_key(case):
+    return f"{case['count']} x {case['size'][0]}x{case['size'][1]}"
+
+
+def stage_seconds(run, name):
+    return run["total"] if name == "total" else run["stages"].get(name, 0)
+
+
+def print_results(results, baseline=None):
+    """Print the best run of every case; with a baseline, the change in percent"""
+    old = {case_key(case): case["best"] for case in (baseline or {}).get("cases", [])}
+    for case in results:
+        best = case["best"]
+        before = old.get(case_key(case))
+        print(f"{case_key(case)}: {best['defects']}个缺陷, {best['pictures']}张图片")
+        for name in ["total", *STAGES]:
+            seconds = stage_seconds(best, name)
+            line = f"  {name:<20}{seconds:>10.3f}s"
+            if before is not None:
+                previous = stage_seconds(before, name)
+                if previous > 0:
+                    line += f"  {(seconds - previous) / previous:+7.0%}"
+            print(line)
+        memory = best["peak_rss_mb"]
+        print(f"  {'peak memory':<20}{memory if memory is not None else '-':>10} MB")
+        print(f"  {'output':<20}{best['output_bytes'] / (1 << 20):>10.1f} MB")
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="用合成的缺陷图片测试生成报告的性能")
+    parser.add_argument(
+        "-n", "--counts", default="100,1000", help="缺陷数量, 多个用逗号分隔"
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        default="1920x1080,4000x3000",
+        help="图片分辨率, 多个用逗号分隔",
+    )
+    parser.add_argument(
+        "-t", "--template", default=ptw.template_file_name, help="模板文件"
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1, help="每组重复次数, 取最快的一次"
+    )
+    parser.add_argument("-w", "--workers", type=int, default=0, help="图片处理并发数")
+    parser.add_argument("--shards", type=int, default=0, help="明细表渲染进程数")
+    parser.add_argument(
+        "--staged", action="store_true", help="预处理完所有图片后再生成文档, 不使用流水线"
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "pic2wd_benchmark"),
+        help="合成图片的保存目录, 参数相同时重复使用",
+    )
+    parser.add_argument("-o", "--output", help="保存结果的JSON文件")
+    parser.add_argument("--compare", help="与之前保存的结果文件比较")
+    parser.add_argument(
+        "--tracemalloc", action="store_true", help="同时记录Python内存分配的峰值(较慢)"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cases = [
+        (int(count), parse_size(size))
+        for count in args.counts.split(",")
+        for size in args.sizes.split(",")
+    ]
+    template = os.path.abspath(args.template)
+    options = {"render_shards": args.shards, "pipeline_images": not args.staged}
+    results = run_cases(
+        cases,
+        template,
+        args.data_dir,
+        args.repeat,
+        args.workers,
+        options,
+        args.tracemalloc,
+    )
+    report = {
+        "version": BENCHMARK_VERSION,
+        "revision": git_revision(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {
+            "template": os.path.basename(template),
+            "repeat": args.repeat,
+            "workers": args.workers,
+            **options,
+            "image_dpi": ptw.image_dpi,
+            "image_quality": ptw.image_quality,
+        },
+        "cases": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
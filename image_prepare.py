@@ -0,0 +1,490 @@
+from dataclasses import dataclass
+import hashlib
+from io import BytesIO
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+
+CM_PER_INCH = 2.54
+COPY_CHUNK_SIZE = 1 << 20
+# 预处理结果的版本, 处理方式改变时缓存文件名随之改变, 不再使用旧的结果
+PREPARE_VERSION = 2
+# JPEG按比例解码时至少保留目标尺寸的倍数, 再用 LANCZOS 缩小, 与 Image.thumbnail() 相同
+DRAFT_GAP = 2
+EXIF_ORIENTATION = 0x0112
+# 需要旋转的图片和RGB编码的JPEG无法无损去除exif信息, 重新压缩时使用的质量
+ROTATED_QUALITY = 95
+# 不超过插入位置尺寸和字节预算(每像素位数)的图片直接插入, 不解码也不复制
+PASS_THROUGH_FORMATS = ("JPEG", "PNG")
+PASS_THROUGH_BITS_PER_PIXEL = 4
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# 保留的APP段: APP0(JFIF), APP2(ICC颜色配置), APP14(Adobe颜色变换), 其余APP段和注释都是元数据
+KEEP_APP_SEGMENTS = {0xE0: b"JFIF", 0xE2: b"ICC_PROFILE", 0xEE: b"Adobe"}
+# 没有长度字段的标记: TEM, RST0~RST7
+STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+# 帧头标记 SOF0~SOF15, 不包括 DHT, JPG, DAC
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# python-docx 只能识别紧跟在 SOI 之后的 JFIF 或 Exif 段, 去除exif后补充一个最小的 JFIF 段:
+# 版本1.01, 没有分辨率单位, 像素宽高比1:1, 没有缩略图
+JFIF_SEGMENT = b"\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+
+
+# 计算图片在文档中的目标像素尺寸
+def target_pixel_size(width_cm, height_cm, dpi):
+    """Convert the slot size in centimeters to pixels at the given DPI"""
+    return (
+        max(1, round(width_cm / CM_PER_INCH * dpi)),
+        max(1, round(height_cm / CM_PER_INCH * dpi)),
+    )
+
+
+def exif_orientation(img):
+    """EXIF orientation (1-8) of an opened image, 1 when there is none"""
+    orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    return orientation if orientation in range(1, 9) else 1
+
+
+# 读取图片文件头: 格式, 尺寸, 方向和元数据, 不解码像素
+@dataclass(frozen=True)
+class ImageProbe:
+    """Header information of an image file"""
+
+    format: str
+    width: int  # 显示的宽高, 已按EXIF方向交换
+    height: int
+    orientation: int
+    metadata: bool  # 是否有 exif/XMP/注释 等元数据
+    size: int  # 文件字节数
+    recognized: bool = True  # python-docx 能否识别文件头, 不能时不直接插入原文件
+
+
+# JFIF 规定三个分量的JPEG是 YCbCr 编码, Adobe 段标记为RGB编码(transform 0)的JPEG
+# 补充 JFIF 段后颜色会被解码错误, 只能重新压缩
+def _is_adobe_rgb(img):
+    return img.format == "JPEG" and img.layers == 3 and img.info.get("adobe_transform") == 0
+
+
+def _has_metadata(img):
+    if img.format != "JPEG":
+        return any(key in img.info for key in ("exif", "xmp", "XML:com.adobe.xmp"))
+    for name, payload in img.applist:
+        marker = 0xFE if name == "COM" else 0xE0 + int(name[3:])
+        if _is_metadata_segment(marker, payload):
+            return True
+    return False
+
+
+# python-docx 只按 SOI 之后第一个段的标识(JFIF/Exif)识别JPEG
+def _is_recognized(path, image_format):
+    if image_format != "JPEG":
+        return True
+    with open(path, "rb") as f:
+        return f.read(10)[6:] in (b"JFIF", b"Exif")
+
+
+# 图片数据是否完整, 之后是否还有附加的内容(如手机照片末尾的 SEFT 信息, 动态照片的视频)
+def image_is_intact(path):
+    """Whether a JPEG/PNG file reaches its end marker with nothing but zero
+    padding after it; reads the whole file"""
+    with open(path, "rb") as f:
+        head = f.read(len(PNG_SIGNATURE))
+        f.seek(0)
+        if head.startswith(b"\xff\xd8"):
+            complete = _skip_jpeg(f)
+        elif head == PNG_SIGNATURE:
+            complete = _skip_png(f)
+        else:
+            return False
+        if not complete:
+            return False
+        return not any(
+            chunk.strip(b"\x00") for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b"")
+        )
+
+
+def _skip_jpeg(src):
+    # 逐段跳过标记, 在压缩数据中找 EOI, 停在 EOI 之后
+    try:
+        for marker, _, _ in _jpeg_segments(src):
+            pass
+    except ValueError:
+        return False
+    return marker == 0xD9 or _copy_scan_data(src)
+
+
+def _skip_png(src):
+    # 逐块跳过, 停在 IEND 块之后
+    if src.read(8) != PNG_SIGNATURE:
+        return False
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            return False
+        length = int.from_bytes(header[:4], "big")
+        if header[4:] == b"IEND":
+            return len(src.read(length + 4)) == length + 4
+        src.seek(length + 4, os.SEEK_CUR)
+
+
+def probe_image(image_path):
+    """ImageProbe of the file from its header, raising ValueError when it cannot be read.
+
+    Only the header is read; whether the data is complete is checked by
+    prepare_unless_intact() for the pictures that would be embedded as they are.
+    """
+    try:
+        with Image.open(image_path) as img:
+            orientation = exif_orientation(img)
+            width, height = img.size
+            if orientation >= 5:
+                width, height = height, width
+            probe = ImageProbe(
+                img.format,
+                width,
+                height,
+                orientation,
+                _has_metadata(img),
+                os.path.getsize(image_path),
+                _is_recognized(image_path, img.format),
+            )
+    except (OSError, SyntaxError, ValueError) as e:
+        raise ValueError(f"无法识别的图片: {e}") from e
+    return probe
+
+
+def fits_slot(probe, width_cm, height_cm, dpi=150):
+    """Whether the image can be embedded as it is: upright, without metadata,
+    readable by python-docx and within the pixel size and byte budget of the slot"""
+    width, height = target_pixel_size(width_cm, height_cm, dpi)
+    return (
+        probe.format in PASS_THROUGH_FORMATS
+        and probe.orientation == 1
+        and not probe.metadata
+        and probe.recognized
+        and probe.width <= width
+        and probe.height <= height
+        and probe.size <= width * height * PASS_THROUGH_BITS_PER_PIXEL // 8
+    )
+
+
+# 草稿模式不插入图片时, 所有位置共用的占位图片
+def placeholder_image(width=4, height=3, color=(224, 224, 224)):
+    """A small plain JPEG, stretched to the slot like any other picture"""
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+# 缩放并重新编码图片
+def prepare_image(image_path, width_cm, height_cm, dpi=150, quality=85):
+    """Resize the image to the slot size at the target DPI and re-encode it as JPEG.
+
+    The picture is stretched to the slot in the document anyway, so each axis is
+    scaled independently and never enlarged. The EXIF orientation is applied to
+    the pixels, since re-encoding drops the EXIF data; upright JPEGs that already
+    fit the slot are only stripped of their metadata.
+    JPEGs are decoded at a reduced scale (1/2 .. 1/8) close to the target size,
+    so a 7x7 cm close-up never decodes a camera picture at full resolution.
+    """
+    target_width, target_height = target_pixel_size(width_cm, height_cm, dpi)
+    with Image.open(image_path) as img:
+        orientation = exif_orientation(img)
+        # 方向 5~8 旋转了90度, 存储的宽高与显示的宽高相反
+        rotated = orientation >= 5
+        width, height = (img.height, img.width) if rotated else img.size
+        size = (min(width, target_width), min(height, target_height))
+        if (
+            size == (width, height)
+            and img.format == "JPEG"
+            and orientation == 1
+            and not _is_adobe_rgb(img)
+        ):
+            # 尺寸已经合适, 只去除元数据, 不重新编码
+            buffer = BytesIO()
+            with open(image_path, "rb") as src:
+                strip_jpeg_metadata(src, buffer)
+            return buffer.getvalue()
+        # 只对JPEG有效: 解码时直接缩小, 尺寸不小于目标的 DRAFT_GAP 倍
+        draft_size = size[::-1] if rotated else size
+        img.draft(None, (draft_size[0] * DRAFT_GAP, draft_size[1] * DRAFT_GAP))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        if size != img.size:
+            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        buffer = BytesIO()
+        img.save(buffer, "JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _read_exact(src, size):
+    data = src.read(size)
+    if len(data) != size:
+        raise ValueError("JPEG文件不完整")
+    return data
+
+
+def _is_metadata_segment(marker, payload):
+    if marker == 0xFE:
+        return True
+    if not 0xE0 <= marker <= 0xEF:
+        return False
+    signature = KEEP_APP_SEGMENTS.get(marker)
+    return signature is None or not payload.startswith(signature)
+
+
+# 逐段读取JPEG标记, 到第一次扫描(SOS)或图片结束(EOI)为止
+def _jpeg_segments(src):
+    """Yield (marker, header, payload) for every segment after SOI, up to and
+    including the first SOS or EOI; header is the marker and length bytes"""
+    if _read_exact(src, 2) != b"\xff\xd8":
+        raise ValueError("不是JPEG文件")
+    while True:
+        prefix = _read_exact(src, 2)
+        while prefix[1] == 0xFF:  # 标记前的填充字节
+            prefix = prefix[1:] + _read_exact(src, 1)
+        if prefix[0] != 0xFF:
+            raise ValueError("JPEG标记错误")
+        marker = prefix[1]
+        if marker in STANDALONE_MARKERS or marker == 0xD9:
+            yield marker, prefix, b""
+            if marker == 0xD9:
+                return
+            continue
+        length = _read_exact(src, 2)
+        if int.from_bytes(length, "big") < 2:
+            raise ValueError("JPEG标记错误")
+        payload = _read_exact(src, int.from_bytes(length, "big") - 2)
+        yield marker, prefix + length, payload
+        if marker == 0xDA:
+            return
+
+
+# SOS 之后是压缩数据, 复制到 EOI 为止(压缩数据中的 0xFF 都会被填充为 0xFF00)
+def _copy_scan_data(src, dst=None):
+    """Copy the data after SOS up to and including EOI to dst (if any) and leave
+    src just after EOI; False when the stream ends before EOI"""
+    tail = b""
+    while True:
+        chunk = src.read(COPY_CHUNK_SIZE)
+        if not chunk:
+            if dst is not None:
+                dst.write(tail)
+            return False
+        data = tail + chunk
+        end = data.find(b"\xff\xd9")
+        if end >= 0:
+            if dst is not None:
+                dst.write(data[: end + 2])
+            src.seek(end + 2 - len(data), os.SEEK_CUR)
+            return True
+        if dst is not None:
+            dst.write(data[:-1])
+        tail = data[-1:]
+
+
+# 无损去除exif: 逐段复制JPEG标记, 跳过元数据段, 压缩数据原样复制
+def strip_jpeg_metadata(src, dst):
+    """Copy a JPEG stream from src to dst without its EXIF/XMP/IPTC/comment segments.
+
+    Only the marker segments before the first scan are inspected; the entropy-coded
+    data is copied byte for byte up to the EOI marker, so the pixels are untouched.
+    Anything appended after EOI (e.g. MPF preview images) is dropped as well.
+    The output always starts with a JFIF segment, which python-docx needs to
+    recognize a JPEG once the EXIF segment is gone; Adobe RGB JPEGs, whose colors
+    a JFIF segment would change, raise ValueError, as do truncated streams.
+    """
+    # 第一次扫描之前的段先保存下来, JFIF 段放在最前面
+    jfif = JFIF_SEGMENT
+    segments = []
+    components = adobe_transform = None
+    for marker, header, payload in _jpeg_segments(src):
+        if marker == 0xD9:
+            dst.write(b"\xff\xd8" + jfif + b"".join(segments) + header)
+            return
+        if _is_metadata_segment(marker, payload):
+            continue
+        if marker == 0xE0 and jfif is JFIF_SEGMENT:
+            jfif = header + payload
+            continue
+        if marker == 0xEE and len(payload) >= 12:
+            adobe_transform = payload[11]
+        elif marker in SOF_MARKERS and len(payload) >= 6:
+            components = payload[5]
+        segments.append(header + payload)
+    if jfif is JFIF_SEGMENT and components == 3 and adobe_transform == 0:
+        raise ValueError("RGB编码的JPEG无法无损去除exif信息")
+    dst.write(b"\xff\xd8" + jfif + b"".join(segments))
+    if not _copy_scan_data(src, dst):
+        raise ValueError("JPEG文件不完整")
+
+
+# 临时文件名区分进程和线程, 写完后再改名, 并发写同一个文件时不会读到写了一半的文件
+def _tmp_path(path):
+    return f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+
+
+def strip_image_metadata(image_path, output_path):
+    """Write a metadata-free copy of a JPEG file to output_path.
+
+    The copy is lossless unless the EXIF orientation asks for a rotation: that
+    is applied to the pixels and the picture re-encoded at ROTATED_QUALITY,
+    otherwise it would be shown sideways once the EXIF data is gone. Adobe RGB
+    JPEGs are re-encoded the same way, see strip_jpeg_metadata().
+    """
+    tmp_path = _tmp_path(output_path)
+    with Image.open(image_path) as img:
+        if exif_orientation(img) != 1 or _is_adobe_rgb(img):
+            img = ImageOps.exif_transpose(img)
+            img.save(tmp_path, "JPEG", quality=ROTATED_QUALITY, optimize=True)
+            os.replace(tmp_path, output_path)
+            return output_path
+    try:
+        with open(image_path, "rb") as src, open(tmp_path, "wb") as dst:
+            strip_jpeg_metadata(src, dst)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def file_digest(path):
+    """SHA-256 of the file content, as a hex string"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# 缓存文件名由原图内容的哈希和处理参数决定, 参数不变时可以直接复用
+def prepared_file_name(digest, width_cm, height_cm, dpi=150, quality=85):
+    """Cache file name of the image prepared by prepare_image()"""
+    width, height = target_pixel_size(width_cm, height_cm, dpi)
+    return f"{digest}_{width}x{height}_q{quality}_v{PREPARE_VERSION}.jpg"
+
+
+def stripped_file_name(digest):
+    """Cache file name of the image stripped by strip_image_metadata()"""
+    return f"{digest}_v{PREPARE_VERSION}.jpg"
+
+
+# 预处理后的图片缓存: 按内容寻址, 超出容量时删除最久未使用的文件
+class ImageCache:
+    """Content-addressed store of prepared images with a byte budget.
+
+    Files are named by the source digest and the processing settings, written
+    atomically and touched on every hit; evict() deletes the least recently used
+    files once the directory holds more than max_bytes (0 means no limit).
+    Several threads or processes may share the directory. evict() spares files
+    used since the caller started, but another process may still evict them:
+    readers call get() again right before reading a file and prepare it again
+    when it is gone.
+    """
+
+    def __init__(self, cache_dir, max_bytes=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, name):
+        """Path of the cached file, marked as recently used, or None"""
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, name, data):
+        path = self.path(name)
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def evict(self, keep_after=0):
+        """Delete least recently used files until the budget is met.
+
+        Files used after the keep_after timestamp are never deleted, so images a
+        running report still has to embed stay in place. Returns the number of
+        deleted files.
+        """
+        if self.max_bytes <= 0 or not os.path.isdir(self.cache_dir):
+            return 0
+        files = []
+        total = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".jpg") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        removed = 0
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes or mtime >= keep_after:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+
+def prepare_image_file(image_path, cache, width_cm, height_cm, dpi=150, quality=85):
+    """prepare_image() through the cache, returning (source digest, cache file name, hit)"""
+    digest = file_digest(image_path)
+    name = prepared_file_name(digest, width_cm, height_cm, dpi, quality)
+    if cache.get(name) is not None:
+        return digest, name, True
+    cache.put(name, prepare_image(image_path, width_cm, height_cm, dpi, quality))
+    return digest, name, False
+
+
+def strip_image_file(image_path, cache):
+    """strip_image_metadata() through the cache, returning (source digest, cache file name, hit)"""
+    digest = file_digest(image_path)
+    name = stripped_file_name(digest)
+    if cache.get(name) is not None:
+        return digest, name, True
+    strip_image_metadata(image_path, cache.path(name))
+    return digest, name, False
+
+
+# 可以直接插入的图片在工作线程/进程中读完整个文件确认完整, 不完整或有附加内容时照常处理
+def prepare_unless_intact(func, pass_through, image_path, *args):
+    """None when pass_through and the file is intact (embed the original as it
+    is, see image_is_intact()), otherwise func(image_path, *args)"""
+    if pass_through and image_is_intact(image_path):
+        return None
+    return func(image_path, *args)
+
+
+# 在工作线程/进程中批量执行, 每张图片单独记录结果和异常
+def run_chunk(func, chunk):
+    """Call func(*args) for every (key, args) item, returning (key, result, error) tuples"""
+    results = []
+    for key, args in chunk:
+        try:
+            results.append((key, func(*args), None))
+        except Exception as e:
+            results.append((key, None, f"{type(e).__name__}: {e}"))
+    return results
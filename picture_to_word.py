@@ -1,19 +1,64 @@
+import argparse
+import cProfile
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
 from copy import deepcopy
+import csv
+from dataclasses import dataclass, replace
 from datetime import datetime
+from functools import partial, wraps
+import hashlib
+from io import BytesIO
+from itertools import chain, count, islice
+import json
 import os
+import pickle
+import queue
+import re
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
 
 from docx import Document
-from PIL import Image
 from docx.enum.text import WD_PARAGRAPH_ALIGNMENT
 from docx.enum.table import WD_CELL_VERTICAL_ALIGNMENT
-from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
-from docx.enum.text import WD_BREAK
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from docx.image.image import Image
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PACKAGE_URI, PackURI
+from docx.opc.pkgwriter import _ContentTypesItem
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.oxml.shape import CT_Inline
+from docx.parts.image import ImagePart
+from docx.table import Table
 from docx.text.paragraph import Paragraph
 from docx.oxml.xmlchemy import OxmlElement
 from docx.oxml.xmlchemy import BaseOxmlElement
 from docx.oxml.ns import qn
 from docx.shared import Cm, Inches
 from inputimeout import inputimeout, TimeoutOccurred
+from lxml import etree
+
+from image_prepare import (
+    ImageCache,
+    fits_slot,
+    prepare_image,
+    prepare_image_file,
+    prepare_unless_intact,
+    placeholder_image,
+    prepared_file_name,
+    probe_image,
+    run_chunk,
+    strip_image_file,
+    strip_image_metadata,
+    stripped_file_name,
+)
 
 
 bugMap = {
@@ -25,11 +70,8 @@ bugMap = {
     "杆塔倾斜": "基础",
     "塔基植被覆盖": "基础",
     "塔基杂物堆积": "基础",
-    "杆塔倾斜": "基础",
     "塔基树障": "基础",
-    "杆塔异物": "基础",
     "杆塔裂纹": "基础",
-    "杆塔未封顶": "基础",
     "杆塔损伤": "基础",
     "塔头破损": "基础",
     "杆塔破损": "基础",
@@ -73,17 +115,164 @@ bugMap = {
     "避雷器连接线脱落": "避雷器",
 }
 
-bug_type_count_map = {}
-total_statis_map = {}
-image_index = {}
+# 模糊匹配规则: 缺陷描述中包含关键字时归入对应类别, 排在前面的规则优先
+fuzzy_rules = [
+    ("绝缘子", ["绝缘子"]),
+    ("基础", ["杆塔", "塔基", "塔头", "塔顶"]),
+    ("金具", ["金具", "销钉", "螺母"]),
+    ("附属设施", ["保护壳", "标识牌"]),
+    ("导地线", ["地线", "导线"]),
+    ("避雷器", ["避雷器"]),
+    ("变压器", ["变压器"]),
+    ("通道", ["通道"]),
+]
+
 bug_type_map = {1: "危急", 2: "严重", 3: "一般"}
-close_up_map = {}
-image_bug_level_map = {}
-image_bug_reason_map = {}
-image_tower_map = {}
-image_route_name_map = {}
-image_type_map = {}
-pic_name_cache = {}
+bug_index_prefix = {1: "A", 2: "B", 3: "C"}  # 明细表编号前缀
+# 定位用的段落文字
+paragraph_anchors = [f"{name}缺陷明细表" for name in bug_type_map.values()]
+paragraph_anchors.append("本次现场巡检")
+# 明细表模板中的占位符
+PLACEHOLDER_PATTERN = re.compile("\ue000(\\w+)\ue001")
+
+
+# 性能统计: 记录各阶段的耗时和计数, 生成结束后输出汇总表, 可以保存为 trace 文件
+class Instrumentation:
+    """Per-stage wall time and counters of one report.
+
+    Every ReportBuilder has its own, so concurrent reports do not mix their
+    numbers. stage() accumulates the calls, inclusive seconds and exclusive
+    seconds (without the stages nested in it on the same thread) of a stage,
+    count() adds to a counter. With trace_events on, every stage is also kept
+    as a Chrome trace event (chrome://tracing, Perfetto) for save().
+    """
+
+    def __init__(self, trace_events=False):
+        self.trace_events = trace_events
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stages = {}  # 阶段名称 -> [调用次数, 耗时(秒), 不含嵌套阶段的耗时(秒)]
+        self.counters = Counter()
+        self.events = []
+        self.started = time.perf_counter()
+
+    def _nested(self):
+        # 本线程正在计时的各层阶段中, 嵌套阶段已用的时间
+        if not hasattr(self._local, "nested"):
+            self._local.nested = []
+        return self._local.nested
+
+    def _begin(self, name):
+        with self._lock:
+            return self.stages.setdefault(name, [0, 0.0, 0.0])
+
+    def _end(self, totals, seconds, own):
+        with self._lock:
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += own
+
+    @contextmanager
+    def stage(self, name):
+        totals = self._begin(name)
+        nested = self._nested()
+        nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            own = end - start - nested.pop()
+            if len(nested) > 0:
+                nested[-1] += end - start
+            self._end(totals, end - start, own)
+            if self.trace_events:
+                with self._lock:
+                    self.events.append(
+                        {
+                            "name": name,
+                            "ph": "X",
+                            "ts": round((start - self.started) * 1e6),
+                            "dur": round((end - start) * 1e6),
+                            "pid": os.getpid(),
+                            "tid": threading.get_ident(),
+                        }
+                    )
+
+    def timed_iter(self, name, items):
+        """Yield from items; the time spent producing them is one call of stage name.
+
+        For generators consumed by another stage, e.g. the directory scan feeding
+        the worker pool. The time is not one span, so it is not traced.
+        """
+        totals = self._begin(name)
+        nested = self._nested()
+        items = iter(items)
+        seconds = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - start
+                    seconds += elapsed
+                    if len(nested) > 0:
+                        nested[-1] += elapsed
+                yield item
+        finally:
+            self._end(totals, seconds, seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def summary(self):
+        """The stages and counters as log lines, stages in the order they started"""
+        total = time.perf_counter() - self.started
+        lines = [f"{'阶段':<24}{'次数':>6}{'耗时(秒)':>11}{'占比':>8}"]
+        for name, (calls, seconds, _) in self.stages.items():
+            share = seconds / total if total > 0 else 0
+            lines.append(f"{name:<26}{calls:>8}{seconds:>14.3f}{share:>10.1%}")
+        lines.append(f"{'合计':<24}{'':>8}{total:>14.3f}")
+        for name, value in self.counters.items():
+            lines.append(f"{name:<26}{value:>8}")
+        return lines
+
+    def to_dict(self):
+        return {
+            "total": time.perf_counter() - self.started,
+            "stages": {
+                name: {"calls": calls, "seconds": seconds, "exclusive": own}
+                for name, (calls, seconds, own) in self.stages.items()
+            },
+            "counters": dict(self.counters),
+            "traceEvents": self.events,
+        }
+
+    def save(self, file_name):
+        """Write the timings, counters and trace events as JSON"""
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+def timed(name=None):
+    """Decorator: run a ReportBuilder method as a stage of the builder's
+    instrumentation, named after the method by default"""
+
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.instrumentation.stage(stage_name):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 def set_cell_border(cell, **kwargs):
@@ -125,62 +314,168 @@ def set_cell_border(cell, **kwargs):
                     element.set(qn("w:{}".format(key)), str(edge_data[key]))
 
 
-# 缺陷描述和缺陷类别不匹配时，模糊匹配
-def fuzzy_match(bug_detail=""):
-    """When the exact match fails, fuzzy matching is used"""
-    if any(keyword in bug_detail for keyword in ["绝缘子"]):
-        return "绝缘子"
-    if any(keyword in bug_detail for keyword in ["杆塔", "塔基", "塔头", "塔顶"]):
-        return "基础"
-    if any(keyword in bug_detail for keyword in ["金具", "销钉", "螺母"]):
-        return "金具"
-    if any(keyword in bug_detail for keyword in ["保护壳", "标识牌"]):
-        return "附属设施"
-    if any(keyword in bug_detail for keyword in ["地线", "导线"]):
-        return "导地线"
-    if any(keyword in bug_detail for keyword in ["避雷器"]):
-        return "避雷器"
-    if any(keyword in bug_detail for keyword in ["变压器"]):
-        return "变压器"
-    if any(keyword in bug_detail for keyword in ["通道"]):
-        return "通道"
-    debug_log(f"{bug_detail} 未匹配到缺陷类别", 2)
-    return ""
+# 缺陷分类: 先按缺陷描述精确匹配, 再按关键字模糊匹配, 结果按缺陷描述缓存
+class BugClassifier:
+    """Map a defect description to its category.
+
+    Exact descriptions are looked up in a dict. Otherwise every keyword is
+    searched in one pass of a single compiled regex and the first listed rule
+    that matches wins. Results are memoized per description, so each distinct
+    description is classified and reported only once.
+    """
+
+    def __init__(self, exact=None, rules=None):
+        self.exact = dict(exact or {})
+        self.rules = list(rules or [])
+        self.compile()
+
+    def compile(self):
+        """Rebuild the keyword matcher after exact or rules changed"""
+        self._priority = {}  # 关键字 -> 规则序号
+        for priority, (category, keywords) in enumerate(self.rules):
+            for keyword in keywords:
+                self._priority.setdefault(keyword, priority)
+        # 零宽先行断言可以在每个位置尝试匹配, 同一位置按规则顺序优先
+        keywords = sorted(self._priority, key=lambda k: (self._priority[k], -len(k)))
+        self._pattern = None
+        if len(keywords) > 0:
+            self._pattern = re.compile(f"(?=({'|'.join(map(re.escape, keywords))}))")
+        self._memo = {}
+
+    def load(self, file_name):
+        """Add the descriptions and keyword rules of a JSON file, ahead of the current ones"""
+        with open(file_name, encoding="utf-8") as f:
+            data = json.load(f)
+        self.exact.update(data.get("exact", {}))
+        rules = [(rule["category"], rule["keywords"]) for rule in data.get("keywords", [])]
+        self.rules = rules + self.rules
+        self.compile()
+
+    def categories(self):
+        """All categories, in the order they first appear"""
+        categories = list(self.exact.values()) + [category for category, _ in self.rules]
+        return list(dict.fromkeys(categories))
+
+    def classify(self, bug_reason=""):
+        category = self._memo.get(bug_reason)
+        if category is None:
+            category = self._memo[bug_reason] = self._classify(bug_reason)
+        return category
+
+    def _classify(self, bug_reason):
+        category = self.exact.get(bug_reason, "")
+        if len(category) > 0:
+            return category
+        # 缺陷描述和缺陷类别不匹配时，模糊匹配
+        priorities = []
+        if self._pattern is not None:
+            priorities = [
+                self._priority[m.group(1)] for m in self._pattern.finditer(bug_reason)
+            ]
+        if len(priorities) == 0:
+            debug_log(f"{bug_reason} 未匹配到缺陷类别", 2)
+            return ""
+        category = self.rules[min(priorities)][0]
+        debug_log(
+            f"缺陷描述:\033[32m[{bug_reason}]\033[m 未匹配到缺陷类别,已模糊匹配为 >>> \033[32m{category}\033[m",
+            1,
+        )
+        return category
+
+
+bug_classifier = BugClassifier(bugMap, fuzzy_rules)
 
 
 def get_bug_type(bug_reason=""):
     """Get the defect type based on the defect description"""
-    bugType = bugMap.get(bug_reason, "")
-    if len(bugType) == 0:
-        bugType = fuzzy_match(bug_reason)
-        if len(bugType) > 0:
-            debug_log(
-                f"缺陷描述:\033[32m[{bug_reason}]\033[m 未匹配到缺陷类别,已模糊匹配为 >>> \033[32m{bugType}\033[m",
-                1,
-            )
-    return bugType
+    return bug_classifier.classify(bug_reason)
 
 
-# statis_add_table 汇总数据写入
-def set_detail_statis(table, images, bug_type):
-    debug_log(f"开始处理 {bug_type_map.get(bug_type,'')}缺陷汇总表")
-    c = 1
-    for i in images:
-        picName = get_pic_name(i)
-        bugLevel = image_bug_level_map.get(i, "")
+# 缺陷统计: 缺陷类别 x 缺陷等级 的交叉统计表, 一次遍历所有图片得到, 与生成文档无关
+class DefectStatistics:
+    """Category x severity counts of the defect pictures, with "合计" margins.
+
+    matrix[category, level] is the number of defects; the "合计" row and column
+    hold the totals. Pictures without a category are not counted.
+    """
 
-        bugType = get_bug_type(image_bug_reason_map.get(i, ""))
-        # 汇总数据
-        if len(bugType) > 0:
-            update_bug_type_count(bugType, bugLevel)
+    TOTAL = "合计"
 
-        update_cell(table, c, 0, str(c))
-        update_cell(table, c, 1, picName[:-3])
-        update_cell(table, c, 2, bugType)
-        update_cell(table, c, 3, bugLevel)
-        update_cell(table, c, 4, image_index.get(i, ""))
-        c += 1
-    debug_log(f"{bug_type_map.get(bug_type,'')}缺陷汇总表 写入完成")
+    def __init__(self, records, categories=(), levels=()):
+        self.matrix = Counter()
+        for record in records:
+            if len(record.category) == 0:
+                continue
+            for category in (record.category, self.TOTAL):
+                for level in (record.level, self.TOTAL):
+                    self.matrix[category, level] += 1
+        # 导出时的行列顺序: 给定的类别和等级在前, 其余按出现的顺序
+        found = list(dict.fromkeys(key for key in self.matrix))
+        self.categories = list(
+            dict.fromkeys([*categories, *(c for c, _ in found if c != self.TOTAL)])
+        )
+        self.levels = list(
+            dict.fromkeys([*levels, *(l for _, l in found if l != self.TOTAL)])
+        )
+
+    def count(self, category=TOTAL, level=TOTAL):
+        return self.matrix[category, level]
+
+    def by_category(self, category=TOTAL):
+        """{level: count} of one category (or of all), empty when it has no defects"""
+        return {
+            level: n
+            for (row, level), n in self.matrix.items()
+            if row == category and n > 0
+        }
+
+    def rows(self):
+        """The matrix as table rows, header first"""
+        levels = [*self.levels, self.TOTAL]
+        rows = [["缺陷类别", *levels]]
+        for category in [*self.categories, self.TOTAL]:
+            rows.append([category, *(self.count(category, level) for level in levels)])
+        return rows
+
+    def to_dict(self):
+        levels = [*self.levels, self.TOTAL]
+        return {
+            "levels": self.levels,
+            "categories": {
+                category: {level: self.count(category, level) for level in levels}
+                for category in [*self.categories, self.TOTAL]
+            },
+        }
+
+    def save(self, file_name):
+        """Write the matrix as .csv or .json, by file extension"""
+        if os.path.splitext(file_name)[1].lower() == ".csv":
+            # 带BOM, Excel可以直接打开
+            with open(file_name, "w", encoding="utf-8-sig", newline="") as f:
+                csv.writer(f).writerows(self.rows())
+            return
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+# 批量写入表格行: 直接修改 w:tr/w:tc 元素, 不经过 table.cell() 重建单元格网格
+def write_table_rows(table, rows, start_row=0):
+    """Write row tuples into the table starting at start_row, centered.
+
+    Missing rows are cloned from the last row of the table.
+    """
+    table_add_row(table, start_row + len(rows) - 1)
+    for tr, values in zip(table._tbl.tr_lst[start_row:], rows):
+        for tc, text in zip(tr.tc_lst, values):
+            set_tc_text(tc, text)
+
+
+def set_tc_text(tc, text):
+    """Same as cell.text = text followed by centering the paragraph"""
+    tc.clear_content()
+    p = tc.add_p()
+    p.get_or_add_pPr().jc_val = WD_PARAGRAPH_ALIGNMENT.CENTER
+    p.add_r().text = text
 
 
 # 更新单元格
@@ -208,48 +503,272 @@ def copy_cell_font_size(cell1, cell2):
     cell1.paragraphs[0].runs[0].font.size = cell2.paragraphs[0].runs[0].font.size
 
 
-def update_bug_type_count(bugType, bugLevel):
-    bug_type_count_map.setdefault(bugType, {}).update(
-        {
-            bugLevel: bug_type_count_map.get(bugType, {}).get(bugLevel, 0) + 1,
-            "合计": bug_type_count_map.get(bugType, {}).get("合计", 0) + 1,
+# 明细表模板: 预先生成带占位符的表格XML, 每个缺陷只做字符串替换和解析, 不再复制整个表格
+class DetailTableTemplate:
+    """Precompiled detail table XML with placeholders for the per-defect fields"""
+
+    def __init__(self, tbl):
+        table = Table(deepcopy(tbl), None)
+        # 与逐个单元格填写时的操作一致, 只是填入占位符
+        update_cell(table, 1, 0, self._placeholder("route_name"))
+        update_cell(table, 1, 1, self._placeholder("tower_num"))
+        update_cell(table, 1, 2, self._placeholder("bug_level"))
+        update_cell(table, 2, 1, self._placeholder("bug_reason"))
+        table._cells[9].paragraphs[0].alignment = WD_PARAGRAPH_ALIGNMENT.CENTER
+        table.rows[4].height = Cm(7.34)
+        image_paragraphs = [table._cells[9]._tc.p_lst[0], table._cells[12]._tc.p_lst[0]]
+        insert_row(table, 0, [self._placeholder("title")])
+
+        # 图片插入到所在段落的末尾, 先用只含占位符的 w:r 标记位置
+        for slot, p in enumerate(image_paragraphs):
+            p.add_r().text = self._placeholder(f"image{slot}")
+        # 两个版本: 没有特写图片, 以及有特写图片(特写图片段落左对齐)
+        self._parts = self._split(table._tbl)
+        image_paragraphs[1].get_or_add_pPr().jc_val = WD_PARAGRAPH_ALIGNMENT.LEFT
+        self._close_up_parts = self._split(table._tbl)
+
+    @staticmethod
+    def _placeholder(name):
+        return f"\ue000{name}\ue001"
+
+    @classmethod
+    def _split(cls, tbl):
+        xml = etree.tostring(tbl, encoding="unicode")
+        for slot in range(2):
+            marker = cls._placeholder(f"image{slot}")
+            xml = xml.replace(f"<w:r><w:t>{marker}</w:t></w:r>", marker)
+        # 拆分为 [文本, 字段名, 文本, 字段名, ..., 文本]
+        return PLACEHOLDER_PATTERN.split(xml)
+
+    def render(self, images=("", ""), **values):
+        """Return the w:tbl XML with the placeholders replaced by the values.
+
+        images are the w:r XML of the picture and of the close-up ("" for none).
+        """
+        parts = (self._close_up_parts if images[1] else self._parts)[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            if name.startswith("image"):
+                parts[i] = images[int(name[5:])]
+            else:
+                parts[i] = escape(values[name])
+        return "".join(parts)
+
+
+# 插入图片的 w:r 元素, 由 python-docx 生成一次, 保证与 run.add_picture() 的结果一致
+def _image_run_parts():
+    shape_id, cx, cy = 2147480001, 2147480002, 2147480003
+    p = parse_xml(f"<w:p {nsdecls('w', 'wp', 'r')}/>")
+    inline = CT_Inline.new_pic_inline(shape_id, "rIdMARKER", "NAME", cx, cy)
+    p.add_r().add_drawing(inline)
+    xml = etree.tostring(p, encoding="unicode")
+    xml = xml[xml.index(">") + 1 : xml.rindex("</w:p>")]
+    for old, new in (
+        (f'id="{shape_id}" name="Picture {shape_id}"', "shape"),
+        ("rIdMARKER", "rid"),
+        ('"NAME"', "name"),
+        (f'"{cx}"', "cx"),
+        (f'"{cy}"', "cy"),
+    ):
+        xml = xml.replace(old, f"\ue000{new}\ue001")
+    return PLACEHOLDER_PATTERN.split(xml)
+
+
+IMAGE_RUN_PARTS = _image_run_parts()
+PAGE_BREAK_XML = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+
+def image_run_xml(image, cx, cy):
+    """w:r XML of an inline picture; rId and shape id are left as placeholders"""
+    values = {
+        "shape": "\ue000shape\ue001",
+        "rid": f"\ue000rid_{image.sha1}\ue001",
+        "name": quoteattr(image.filename),
+        "cx": f'"{cx}"',
+        "cy": f'"{cy}"',
+    }
+    parts = IMAGE_RUN_PARTS[:]
+    for i in range(1, len(parts), 2):
+        parts[i] = values[parts[i]]
+    return "".join(parts)
+
+
+# 明细表分片渲染: 可以在工作进程中执行, 生成明细表XML并读取图片
+# 图片的关系ID和形状ID用占位符表示, 合并到文档时再分配
+def render_detail_chunk(items):
+    """Render (template, record, (picture, close-up), page break) items to XML.
+
+    The pictures are prepared image bytes or file paths (close-up may be None).
+    Returns (xml, {sha1: Image}) for merge_detail_chunk().
+    """
+    xml = []
+    images = {}
+    for template, record, sources, page_break in items:
+        runs = []
+        for source, (x, y) in zip(sources, (MAIN_IMAGE_SIZE, CLOSE_UP_IMAGE_SIZE)):
+            if source is None:
+                runs.append("")
+                continue
+            image = Image.from_file(BytesIO(source) if isinstance(source, bytes) else source)
+            images.setdefault(image.sha1, image)
+            cx, cy = image.scaled_dimensions(Cm(x), Cm(y))
+            runs.append(image_run_xml(image, cx, cy))
+        xml.append(
+            template.render(
+                runs,
+                title=f"{record.index} {record.stem}",
+                route_name=record.route,
+                tower_num=record.tower,
+                bug_level=record.level,
+                bug_reason=record.reason,
+            )
+        )
+        if page_break:
+            xml.append(PAGE_BREAK_XML)
+    return "".join(xml), images
+
+
+# 文档中的图片: 按内容去重, 直接分配图片文件名和关系ID
+class MediaRegistry:
+    """Add pictures to a document part in constant time per picture.
+
+    part.get_or_add_image() rescans every image part and relationship for each
+    picture, which is quadratic for thousands of pictures. Part names and rIds
+    are handed out the same way python-docx does: lowest unused number first.
+    """
+
+    def __init__(self, part, writer=None, instrumentation=None):
+        self.part = part
+        self.writer = writer  # DocxStreamWriter: 图片直接写入输出文件, 不保存在内存中
+        self.instrumentation = instrumentation or Instrumentation()
+        self._image_parts = part.package.image_parts
+        self._parts_by_sha1 = {
+            image_part.sha1: image_part for image_part in self._image_parts
         }
-    )
-    bug_type_count_map.setdefault("合计", {}).update(
-        {
-            bugLevel: bug_type_count_map.get("合计", {}).get(bugLevel, 0) + 1,
-            "合计": bug_type_count_map.get("合计", {}).get("合计", 0) + 1,
+        self._rids = {
+            rel.target_part: rId
+            for rId, rel in part.rels.items()
+            if not rel.is_external and rel.reltype == RT.IMAGE
         }
-    )
+        self._used_names = {image_part.partname.idx for image_part in self._image_parts}
+        self._used_rids = {
+            int(rId[3:]) for rId in part.rels if re.fullmatch(r"rId\d+", rId)
+        }
+        self._next_name = 1
+        self._next_rid = 1
+
+    def rid(self, image):
+        """rId of the picture, adding the image part and relationship on first use"""
+        image_part = self._parts_by_sha1.get(image.sha1)
+        if image_part is None:
+            while self._next_name in self._used_names:
+                self._next_name += 1
+            self._used_names.add(self._next_name)
+            partname = PackURI(f"/word/media/image{self._next_name}.{image.ext}")
+            if self.writer is None:
+                image_part = ImagePart.from_image(image, partname)
+            else:
+                self.writer.write_media(partname, image.blob)
+                image_part = StreamedImagePart(partname, image.content_type, image.sha1)
+            self._image_parts.append(image_part)
+            self._parts_by_sha1[image.sha1] = image_part
+            self.instrumentation.count("images_embedded")
+            self.instrumentation.count("bytes_embedded", len(image.blob))
+        rId = self._rids.get(image_part)
+        if rId is None:
+            while self._next_rid in self._used_rids:
+                self._next_rid += 1
+            self._used_rids.add(self._next_rid)
+            rId = f"rId{self._next_rid}"
+            self.part.rels.add_relationship(RT.IMAGE, image_part, rId)
+            self._rids[image_part] = rId
+        return rId
+
+
+# 已经写入输出文件的图片, 只保留文件名和类型, 用于生成关系和内容类型
+class StreamedImagePart(ImagePart):
+    """An image part whose content has already been written by DocxStreamWriter"""
+
+    def __init__(self, partname, content_type, sha1):
+        super().__init__(partname, content_type, b"")
+        self._sha1 = sha1
+
+    @property
+    def sha1(self):
+        return self._sha1
+
+
+# 流式写入 .docx: 图片生成后立即写入压缩包, 最后写入 document.xml 等其余部分
+class DocxStreamWriter:
+    """Write a .docx while it is being built.
+
+    Pictures go into the zip as soon as MediaRegistry adds them, so their bytes
+    are not kept until the end; finish() writes the remaining parts, with
+    word/document.xml last. The file is written under a temporary name and only
+    replaces file_name when finish() succeeds.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._tmp_name = f"{file_name}.tmp{os.getpid()}"
+        self._zip = zipfile.ZipFile(self._tmp_name, "w", zipfile.ZIP_DEFLATED)
+
+    def write_media(self, partname, blob):
+        # 图片已经是压缩格式, 不再压缩
+        self._zip.writestr(partname.membername, blob, zipfile.ZIP_STORED)
+
+    def finish(self, doc, file_name=None):
+        """Write the rest of the document and move the file into place"""
+        package = doc.part.package
+        parts = self._parts(package)
+        for part in parts:
+            part.before_marshal()
+        self._zip.writestr("[Content_Types].xml", _ContentTypesItem.from_parts(parts).blob)
+        self._zip.writestr(PACKAGE_URI.rels_uri.membername, package.rels.xml)
+        for part in sorted(parts, key=lambda part: part is doc.part):
+            if len(part.rels) > 0:
+                self._zip.writestr(part.partname.rels_uri.membername, part.rels.xml)
+            if not isinstance(part, StreamedImagePart):
+                self._zip.writestr(part.partname.membername, part.blob)
+        self._zip.close()
+        os.replace(self._tmp_name, file_name or self.file_name)
+
+    def abort(self):
+        self._zip.close()
+        if os.path.exists(self._tmp_name):
+            os.remove(self._tmp_name)
+
+    @staticmethod
+    def _parts(package):
+        # 与 package.iter_parts() 顺序相同, 用集合记录已访问的部分, 避免逐个比较
+        parts = []
+        visited = set()
+        stack = [iter(package.rels.values())]
+        while stack:
+            rel = next(stack[-1], None)
+            if rel is None:
+                stack.pop()
+                continue
+            if rel.is_external or rel.target_part in visited:
+                continue
+            visited.add(rel.target_part)
+            parts.append(rel.target_part)
+            stack.append(iter(rel.target_part.rels.values()))
+        return parts
 
 
-def get_pic_name(pic):
-    cache_name = pic_name_cache.get(pic, "")
-    if len(cache_name) > 0:
-        return cache_name
-    picName, picType = pic.split(".")
-    pic_name_cache[pic] = picName
-    return picName
-
-
-# 每个图片插入数据到一个表格
-def deal_table(table, pic):
-    debug_log(f"开始处理:{pic}")
-    pic_name = get_pic_name(pic)
-    route_name, tower_num, bug_reason, bug_level = pic_name.split("_")
-    update_cell(table, 1, 0, route_name)
-    update_cell(table, 1, 1, tower_num)
-    update_cell(table, 1, 2, bug_level)
-    update_cell(table, 2, 1, bug_reason)
-
-    insert_image_designation(table, 9, pic, 16.4, 12.3, WD_PARAGRAPH_ALIGNMENT.CENTER)
-    close_up_pic = close_up_map.get(pic_name, "")
-    table.rows[4].height = Cm(7.34)
-    if len(close_up_pic) > 0:
-        insert_image_designation(
-            table, 12, close_up_pic, 7, 7, WD_PARAGRAPH_ALIGNMENT.LEFT
-        )
-    debug_log(f"明细表 {pic_name} 处理完成")
+def merge_detail_chunk(xml, images, registry, shape_ids):
+    """Fill in the rIds and shape ids of a rendered chunk and return its body elements"""
+
+    def resolve(match):
+        name = match.group(1)
+        if name == "shape":
+            shape_id = next(shape_ids)
+            return f'id="{shape_id}" name="Picture {shape_id}"'
+        return registry.rid(images[name[4:]])
+
+    xml = PLACEHOLDER_PATTERN.sub(resolve, xml)
+    return list(parse_xml(f"<w:body {nsdecls('w', 'wp', 'r')}>{xml}</w:body>"))
 
 
 #
@@ -266,267 +785,132 @@ def insert_image_by_rate(table, cell_idx, pic, xRate, yRate, alignment):
     cell.paragraphs[0].alignment = alignment
 
 
-def insert_image_designation(table, cell_idx, pic, x, y, alignment):
-    image_path = "./pic/" + pic
-    cell = table._cells[cell_idx]
-
-    cell.paragraphs[0].add_run().add_picture(
-        image_path,
-        width=Cm(x),
-        height=Cm(y),
-    )
-    cell.paragraphs[0].alignment = alignment
-
-
-# 缺陷数量统计表
-def bug_num_statis(table):
-    bugLevelCountMap = bug_type_count_map.get("合计", {})
-    if len(bugLevelCountMap) == 0:
-        return
-    col = 0
-    for key in table.rows[0].cells:
-        count = bugLevelCountMap.get(key.text, 0)
-        if count > 0:
-            table.cell(1, col).text = str(count)
-            table.cell(1, col).paragraphs[0].runs[0].font.name = statis_number_font
-            if is_set_statis_number_size:
-                copy_cell_font_size(table.cell(1, col), table.cell(0, col))
-            cell_set_center(table.cell(1, col))
-            total_statis_map[key.text] = count
-        col += 1
-
-
-# 缺陷类别统计表
-def bug_type_statis(table):
-    row = 0
-    for rows in table.rows:
-        bugLevelCountMap = bug_type_count_map.get(rows.cells[0].text, {})
-        if len(bugLevelCountMap) > 0 or row >= 2:
-            col = 0
-            for key in table.rows[1].cells:
-                count = bugLevelCountMap.get(key.text, 0)
-                if count > 0 or col >= 1:
-                    table.cell(row, col).text = str(count)
-                    table.cell(row, col).paragraphs[0].runs[
-                        0
-                    ].font.name = statis_number_font
-                    if is_set_statis_number_size:
-                        copy_cell_font_size(table.cell(row, col), table.cell(1, col))
-
-                    cell_set_center(table.cell(row, col))
-                    if key.text == "合计":
-                        total_statis_map[rows.cells[0].text] = count
-                col += 1
-        row += 1
-
-
-# 缺陷情况总览
-def set_total_description(doc):
-    total_description_paragraph = match_text_paragraph(doc, "本次现场巡检")
-    if total_description_paragraph == 0:
-        debug_log(" 定位缺陷情况总览模块失败......", 2)
-        return False
-    para = doc.paragraphs[total_description_paragraph]
-    tpl = para.text
-    font_size = para.runs[0].font.size
-    content = tpl.format(
-        total_bug=total_statis_map.get("合计", 0),
-        weiji_bug=total_statis_map.get("危急", 0),
-        yanzhong_bug=total_statis_map.get("严重", 0),
-        yiban_bug=total_statis_map.get("一般", 0),
-        bileiqi_bug=total_statis_map.get("避雷器", 0),
-        bianyaqi_bug=total_statis_map.get("变压器", 0),
-        daodixian_bug=total_statis_map.get("导地线", 0),
-        fushu_bug=total_statis_map.get("附属设施", 0),
-        jichu_bug=total_statis_map.get("基础", 0),
-        jinjv_bug=total_statis_map.get("金具", 0),
-        jueyuanzi_bug=total_statis_map.get("绝缘子", 0),
-        tongdao_bug=total_statis_map.get("通道", 0),
-    )
-    debug_log(f"缺陷情况总览文字: {content}")
-    doc.paragraphs[total_description_paragraph].text = content
-    doc.paragraphs[total_description_paragraph].runs[0].font.size = font_size
-    return True
-
-
-def deal_close_up_image(pic):
-    """ "Check whether the close-up image is standard"""
-    pic_name, pic_type = pic.split(".")
-    if len(pic_name.split("_")) != 5:
-        debug_log(
-            f"图片名称不规范,不规范的图片为：\033[35m{pic_name}.{pic_type}\033[m ", 2
-        )
-        return False
-    if len(pic_name.split("_特写")) != 2:
-        debug_log(
-            f"图片名称不规范,不规范的图片为：\033[35m{pic_name}.{pic_type}\033[m ", 2
-        )
-        return False
-    close_up_name, _ = pic_name.split("_特写")
-    close_up_map[close_up_name] = pic
-    return True
-
-
-# 获取待处理的图片
-def get_images(image_dir=""):
-    """Image Classification"""
-    image_list = []
-    for root, dirs, pics in os.walk(image_dir):
-        for pic in pics:
-            picName, picType = pic.split(".")
-            pic_name_cache[pic] = picName
-            if len(picName.split("_")) != 4:
-                if not deal_close_up_image(pic):
-                    return
-                continue
-            route_name, tower_num, bug_reason, bug_level = picName.split("_")
-            image_bug_level_map[pic] = bug_level
-            image_bug_reason_map[pic] = bug_reason
-            image_tower_map[pic] = tower_num
-            image_route_name_map[pic] = route_name
-            image_type_map[pic] = picType
-            image_list.append(pic)
-
-    common_list = []
-    critical_list = []
-    emergency_list = []
-    clear_exif(image_list)
-    for i in image_list:
-        bug_level = image_bug_level_map.get(i, "")
-        match bug_level:
-            case "危急":
-                emergency_list.append(i)
-            case "严重":
-                critical_list.append(i)
-            case "一般":
-                common_list.append(i)
-
-    return emergency_list, critical_list, common_list
-
-
-def get_summary_table_index(doc, index=1):
-    """Get summary table location"""
-    i = 0
-    sort = 1
-    for t in doc.tables:
-        if t._cells[1].text == "缺陷描述":
-            if index == sort:
-                return i
-            sort += 1
-        i += 1
-
-
-def match_text_paragraph(doc, text=""):
-    """Get the paragraph where the text is located"""
-    pi = 0
-    for p in doc.paragraphs:
-        if text in p.text:
-            return pi
-        pi += 1
-    return 0
-
-
-def insert_paragraph_after(paragraph, text=None, style=None):
-    """Insert a new paragraph after the given paragraph."""
-    new_p = OxmlElement("w:p")
-    paragraph._p.addnext(new_p)
-    new_para = Paragraph(new_p, paragraph._parent)
-    if text:
-        new_para.add_run(text)
-    if style is not None:
-        new_para.style = style
-    return new_para
-
-
-def missing_table_num(doc, table_index=0, image_num=0):
-    """Get the number of missing detail lists"""
-    for i in range(table_index, table_index + image_num):
-        if i >= len(doc.tables):
-            return table_index + image_num - i
-        table = doc.tables[i]
-        if i > table_index and (table._cells[0].text != "线路名称"):
-            return table_index + image_num - i
-    return 0
-
-
-def get_detail_table_index(doc, index=1):
-    """Get the location of the details table"""
-    i = 0
-    sort = 1
-    for t in doc.tables:
-        if t._cells[0].text == "线路名称":
-            if index == sort:
-                return i
-            sort += 1
-        i += 1
-
-
-def add_missing_table(doc, tbl=None, paragraph_index=0, add_num=0):
-    """Add missing table"""
-
-    if tbl == None:
-        debug_log("获取明细表表格模板失败", 2)
-        return
-
-    if add_num > 0:
-        debug_log(f"危急部分缺少{add_num}个表格")
-        for i in range(add_num):
-            new_tbl = deepcopy(tbl)
-            insert_paragraph_after(
-                doc.paragraphs[paragraph_index + i],
-            ).add_run().add_break(WD_BREAK.PAGE)
-            doc.paragraphs[paragraph_index + i]._p.addnext(new_tbl)
-        debug_log(f"<危急>部分插入{add_num}个表格成功")
+# 文档锚点索引: 一次遍历记录所有表格和定位用的段落, 插入表格时同步更新
+class DocIndex:
+    """One-pass index of the tables and anchor paragraphs in the document body"""
+
+    def __init__(self, doc, anchors=None, snapshot=None):
+        self.tables = []  # 正文中的所有表格, 顺序与 doc.tables 一致
+        self.detail_tables = []  # 明细表在 tables 中的位置
+        self.summary_tables = []  # 汇总表在 tables 中的位置
+        self.paragraphs = {}  # 锚点文字 -> 第一个包含该文字的段落
+        body = doc._body
+        if snapshot is not None:
+            self._restore(doc, snapshot)
+            return
+        anchors = paragraph_anchors if anchors is None else anchors
+        for element in doc.element.body.iterchildren():
+            if element.tag == qn("w:tbl"):
+                self._add_table(Table(element, body))
+            elif element.tag == qn("w:p"):
+                paragraph = Paragraph(element, body)
+                text = paragraph.text
+                for anchor in anchors:
+                    if anchor in text:
+                        self.paragraphs.setdefault(anchor, paragraph)
+
+    def _add_table(self, table):
+        position = len(self.tables)
+        self.tables.append(table)
+        cells = table._cells
+        if cells[0].text == "线路名称":
+            self.detail_tables.append(position)
+        elif len(cells) > 1 and cells[1].text == "缺陷描述":
+            self.summary_tables.append(position)
+
+    def snapshot(self, doc):
+        """Positions of the indexed elements among the body children.
+
+        A copy of the same document can be indexed from the snapshot without
+        reading any text: DocIndex(copy, snapshot=snapshot).
+        """
+        body = doc.element.body
+        return {
+            "tables": [body.index(table._tbl) for table in self.tables],
+            "detail_tables": list(self.detail_tables),
+            "summary_tables": list(self.summary_tables),
+            "paragraphs": {
+                anchor: body.index(paragraph._p)
+                for anchor, paragraph in self.paragraphs.items()
+            },
+        }
 
+    def _restore(self, doc, snapshot):
+        body = doc._body
+        children = list(doc.element.body.iterchildren())
+        self.tables = [Table(children[i], body) for i in snapshot["tables"]]
+        self.detail_tables = list(snapshot["detail_tables"])
+        self.summary_tables = list(snapshot["summary_tables"])
+        self.paragraphs = {
+            anchor: Paragraph(children[i], body)
+            for anchor, i in snapshot["paragraphs"].items()
+        }
 
-def add_missing_rows(doc, table_index=0, image_num=0, bug_type=0):
-    statis_table_rows = len(doc.tables[table_index].rows) - 1
+    def detail_table_index(self, index=1):
+        """Get the location of the index-th details table"""
+        if index > len(self.detail_tables):
+            return None
+        return self.detail_tables[index - 1]
+
+    def summary_table_index(self, index=1):
+        """Get the location of the index-th summary table"""
+        if index > len(self.summary_tables):
+            return None
+        return self.summary_tables[index - 1]
+
+    def paragraph(self, anchor):
+        """Get the first paragraph containing the anchor text"""
+        return self.paragraphs.get(anchor)
+
+    def insert_detail_tables(self, position, tables):
+        """Record detail tables inserted into the body before tables[position]"""
+        count = len(tables)
+        self.tables[position:position] = tables
+        self.summary_tables = [
+            i + count if i >= position else i for i in self.summary_tables
+        ]
+        k = bisect_left(self.detail_tables, position)
+        self.detail_tables[k:] = list(range(position, position + count)) + [
+            i + count for i in self.detail_tables[k:]
+        ]
+
+
+def add_missing_rows(table, image_num=0, bug_type="", prototype=None):
+    statis_table_rows = len(table.rows) - 1
     if statis_table_rows < image_num:
-        table_add_row(doc.tables[table_index], image_num)
+        table_add_row(table, image_num, prototype)
         debug_log(f"{bug_type}缺陷汇总表插入{image_num-statis_table_rows-1}行")
 
 
 # table_add_row 汇总行数小于图片数量时，添加行
-def table_add_row(table, num=0):
-    """Adding rows to a table"""
-    tr = len(table.rows)
-    while tr - 1 < num:
-        new_row = deepcopy(table.rows[-1])
-        table.rows[-1]._tr.addnext(new_row._element)  # 在最后一行后面添加
-        table.rows[-1]._tr.addprevious(new_row._element)
-        tr += 1
-
-
-# 生成模板
-def get_template(emergencyList, criticalList, commonList, file_name=""):
-    # 实例化一个Document对象，相当于打开word软件，新建一个空白文件
-    doc = Document(file_name)
-    # tables = doc.tables  # 获取文档中所有表格对象的列表
-
-    emergency_detail_table_index = get_detail_table_index(doc, 1)
-    critical_detail_table_index = get_detail_table_index(doc, 2)
-    common_detail_table_index = get_detail_table_index(doc, 3)
-    if not (
-        emergency_detail_table_index
-        * critical_detail_table_index
-        * common_detail_table_index
-    ):
-        debug_log("定位危急缺陷明细表失败", 2)
-        return False
-    emergency_statis_table_index = get_summary_table_index(doc, 1)
-    critical_statis_table_index = get_summary_table_index(doc, 2)
-    common_statis_table_index = get_summary_table_index(doc, 3)
-
-    emergency_detail_paragraph = match_text_paragraph(doc, "危急缺陷明细表")
-    if emergency_detail_paragraph == 0:
-        debug_log("定位危急缺陷明细表失败", 2)
-        return False
-
-    # 判断  汇总表行数是否足够
-    add_missing_rows(doc, emergency_statis_table_index, len(emergencyList), "危急")
-    add_missing_rows(doc, critical_statis_table_index, len(criticalList), "严重")
-    add_missing_rows(doc, common_statis_table_index, len(commonList), "一般")
-    tpl_table = doc.tables[emergency_detail_table_index]
+def table_add_row(table, num=0, prototype=None):
+    """Adding rows to a table, cloned from prototype or the last row"""
+    tr_lst = table._tbl.tr_lst
+    missing = num + 1 - len(tr_lst)
+    if missing <= 0:
+        return
+    # 以最后一行为模板, 只复制行元素本身
+    last_tr = tr_lst[-1]
+    if prototype is None:
+        prototype = deepcopy(last_tr)
+    for _ in range(missing):
+        last_tr.addnext(deepcopy(prototype))  # 在最后一行后面添加
+
+
+# 分析模板: 检查定位用的表格和段落, 调整明细表尺寸并预编译明细表模板
+# 结果与图片无关, 由 TemplateCache 缓存
+def analyse_template(index):
+    """Validate the template anchors and compile the detail table templates"""
+    for bug_type, bug_name in bug_type_map.items():
+        if (
+            index.detail_table_index(bug_type) is None
+            or index.summary_table_index(bug_type) is None
+            or index.paragraph(f"{bug_name}缺陷明细表") is None
+        ):
+            debug_log(f"定位{bug_name}缺陷明细表失败", 2)
+            return None
+
+    tpl_table = index.tables[index.detail_table_index(EMERGENCY)]
 
     tpl_table.rows[0].height = Cm(0.85)
     tpl_table.rows[1].height = Cm(0.85)
@@ -543,65 +927,266 @@ def get_template(emergencyList, criticalList, commonList, file_name=""):
     set_cell_size(tpl_table, 2, 0, 8.42, 0.85)
     set_cell_size(tpl_table, 2, 1, 8.42, 0.85)
 
-    tbl = doc.tables[emergency_detail_table_index]._tbl
+    # 明细表模板: 前面的明细表都以<危急>明细表为模板, 每个等级的最后一个明细表使用该等级自己的表格
+    tpl = DetailTableTemplate(tpl_table._tbl)
+    detail_templates = {}
+    for bug_type in bug_type_map:
+        table = index.tables[index.summary_table_index(bug_type) + 1]
+        if table is tpl_table:
+            detail_templates[bug_type] = (tpl, tpl)
+        else:
+            detail_templates[bug_type] = (tpl, DetailTableTemplate(table._tbl))
+    return detail_templates
+
+
+# 生成模板: 在内存中的文档上补齐汇总表行数
+def get_template(index, emergencyList, criticalList, commonList, row_prototypes=None):
+    image_lists = {EMERGENCY: emergencyList, CRITICAL: criticalList, COMMON: commonList}
+    row_prototypes = row_prototypes or {}
+    # 判断  汇总表行数是否足够
+    for bug_type, image_list in image_lists.items():
+        add_missing_rows(
+            index.tables[index.summary_table_index(bug_type)],
+            len(image_list),
+            bug_type_map[bug_type],
+            row_prototypes.get(bug_type),
+        )
+    debug_log("生成模板成功")
+    return True
 
-    # 判断 <危急> 详情表数量是否足够
-    addNum = missing_table_num(doc, emergency_detail_table_index, len(emergencyList))
-    # <危急> 添加表格
-    add_missing_table(doc, tbl, emergency_detail_paragraph, addNum)
-    critical_detail_table_index += addNum
-    common_detail_table_index += addNum
 
-    # 判断 <严重> 详情表数量是否足够
-    critical_detail_paragraph = match_text_paragraph(doc, "严重缺陷明细表")
-    if critical_detail_paragraph == 0:
-        debug_log("严重缺陷明细表失败", 2)
-        return False
-    addNum = missing_table_num(doc, critical_detail_table_index, len(criticalList))
-    # <严重> 添加表格
-    add_missing_table(doc, tbl, critical_detail_paragraph, addNum)
-    common_detail_table_index += addNum
-
-    # 判断 <一般> 详情表数量是否足够
-    common_detail_paragraph = match_text_paragraph(doc, "一般缺陷明细表")
-    if critical_detail_paragraph == 0:
-        debug_log("一般缺陷明细表失败", 2)
-        return False
-    addNum = missing_table_num(doc, common_detail_table_index, len(commonList))
-    add_missing_table(doc, tbl, common_detail_paragraph, addNum)
+# 解析和分析过的模板, 每份报告复制一份文档, 不再重新解析模板文件
+class CachedTemplate:
+    """A parsed, pre-analysed template that hands out cheap copies of itself"""
 
-    doc.save("tpl.docx")
-    debug_log("生成模板成功")
-    return True
+    def __init__(self, key, doc, index, detail_templates):
+        self.key = key
+        self.doc = doc
+        self.snapshot = index.snapshot(doc)
+        self.detail_templates = detail_templates
+        # 汇总表的行模板
+        self.row_prototypes = {
+            bug_type: deepcopy(
+                index.tables[index.summary_table_index(bug_type)]._tbl.tr_lst[-1]
+            )
+            for bug_type in bug_type_map
+        }
 
+    def new_document(self):
+        """Return a copy of the analysed template and its index"""
+        doc = deepcopy(self.doc)
+        return doc, DocIndex(doc, snapshot=self.snapshot)
+
+    # 保存到磁盘时, 文档和XML元素以文本形式保存
+    def __getstate__(self):
+        buffer = BytesIO()
+        self.doc.save(buffer)
+        state = self.__dict__.copy()
+        state["doc"] = buffer.getvalue()
+        state["row_prototypes"] = {
+            bug_type: etree.tostring(tr, encoding="unicode")
+            for bug_type, tr in self.row_prototypes.items()
+        }
+        return state
 
-def deal_one_type_table(doc, table_index, iamge_list, bug_type):
-    debug_log(f"开始处理 {bug_type_map.get(bug_type,'')}明细表")
-    bug_pre = ""
-    match bug_type:
-        case 1:
-            bug_pre = "A"
-        case 2:
-            bug_pre = "B"
-        case 3:
-            bug_pre = "C"
-    if len(iamge_list) == 0:
-        insert_row(doc.tables[table_index + 1], 0, [bug_pre + str(1)])
-        return
-    picIndex = 0
-    for i in range(
-        table_index + 1,
-        table_index + 1 + len(iamge_list),
-    ):
-        table = doc.tables[i]
-        pic = iamge_list[picIndex]
-        deal_table(table, pic)
-        picIndex += 1
-        bug_pre_index = bug_pre + str(picIndex)
-        insert_row(table, 0, [bug_pre_index + " " + get_pic_name(pic)])
-        # todo
-        image_index[pic] = bug_pre_index
-    debug_log(f"{bug_type_map.get(bug_type,'')}明细表 处理完成")
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.doc = Document(BytesIO(state["doc"]))
+        self.row_prototypes = {
+            bug_type: parse_xml(xml) for bug_type, xml in state["row_prototypes"].items()
+        }
+
+
+# 模板缓存: 以模板文件内容的哈希为键, 模板不变时只解析和分析一次
+class TemplateCache:
+    """Analysed templates keyed by the SHA-256 of the template file content.
+
+    Entries are kept in memory, and pickled to cache_dir when it is set.
+    """
+
+    def __init__(self, cache_dir=""):
+        self.cache_dir = cache_dir
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, template):
+        """Get the cached template for a file name or file content, None if it is invalid"""
+        if not isinstance(template, bytes):
+            with open(template, "rb") as f:
+                template = f.read()
+        key = hashlib.sha256(template).hexdigest()
+        with self._lock:
+            cached = self._templates.get(key)
+            if cached is None:
+                cached = self._load(key) or self._analyse(key, template)
+                if cached is None:
+                    return None
+                self._templates[key] = cached
+        return cached
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.v{TEMPLATE_CACHE_VERSION}.pickle")
+
+    def _load(self, key):
+        if len(self.cache_dir) == 0 or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                cached = pickle.load(f)
+        except Exception as e:
+            debug_log(f"读取模板缓存失败, 重新分析模板: {e}", 1)
+            return None
+        debug_log(f"使用模板缓存 {self._path(key)}")
+        return cached
+
+    def _analyse(self, key, data):
+        debug_log("开始分析模板")
+        doc = Document(BytesIO(data))
+        index = DocIndex(doc)
+        detail_templates = analyse_template(index)
+        if detail_templates is None:
+            return None
+        cached = CachedTemplate(key, doc, index, detail_templates)
+        if len(self.cache_dir) > 0:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{self._path(key)}.tmp{os.getpid()}"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(cached, f)
+            os.replace(tmp_path, self._path(key))
+            debug_log(f"模板分析结果已缓存到 {self._path(key)}")
+        return cached
+
+
+# 图片清单: 记录每张图片的大小, 修改时间, 内容哈希, 名称字段和预处理结果
+# 保存在报告旁边, 重新生成时未修改的图片直接使用上次的预处理结果
+class ImageManifest:
+    """Record of the prepared images of one report, saved as JSON in its cache directory.
+
+    An entry is reused while the source file keeps its path, size and modification
+    time; the prepared files live next to the manifest.
+    """
+
+    def __init__(self, path, reuse=True):
+        self.path = path
+        self.cache_dir = os.path.dirname(path) or "."
+        self.entries = {}
+        self._old_entries = self._load() if reuse else {}
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            debug_log(f"读取图片清单失败, 重新处理全部图片: {e}", 1)
+            return {}
+        if data.get("version") != IMAGE_MANIFEST_VERSION:
+            return {}
+        return data.get("images", {})
+
+    def lookup(self, pic, path, stat):
+        """The previous entry of an unchanged image, or None"""
+        entry = self._old_entries.get(pic)
+        if (
+            entry is None
+            or entry["path"] != path
+            or entry["size"] != stat.st_size
+            or entry["mtime_ns"] != stat.st_mtime_ns
+        ):
+            return None
+        return entry
+
+    def record(self, pic, path, stat, digest, fields, cache):
+        self.entries[pic] = {
+            "path": path,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest,
+            "fields": fields,
+            "cache": cache,
+        }
+
+    def save(self, remove_unused=True):
+        """Write the manifest, deleting prepared files no image uses any more"""
+        used = {entry["cache"] for entry in self.entries.values()}
+        for entry in self._old_entries.values() if remove_unused else ():
+            cache_path = os.path.join(self.cache_dir, entry["cache"])
+            if entry["cache"] not in used and os.path.exists(cache_path):
+                os.remove(cache_path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": IMAGE_MANIFEST_VERSION, "images": self.entries},
+                f,
+                ensure_ascii=False,
+                indent=1,
+            )
+        os.replace(tmp_path, self.path)
+
+
+# 图片清单和预处理结果保存在报告旁边的 <报告名>_cache 目录中
+def manifest_path(file_name):
+    return os.path.join(f"{os.path.splitext(file_name)[0]}_cache", "manifest.json")
+
+
+# 图片记录: 文件名只解析一次, 之后的处理都使用解析结果
+@dataclass(frozen=True, slots=True)
+class PhotoRecord:
+    """One picture, parsed from its file name"""
+
+    name: str  # 文件名
+    path: str  # 文件路径
+    stem: str  # 不含扩展名的文件名
+    ext: str  # 扩展名, 不含 "."
+    route: str  # 线路名称
+    tower: str  # 杆号
+    reason: str  # 缺陷描述
+    level: str  # 缺陷等级
+    close_up_of: str = ""  # 特写图片: 对应的主图名称(不含扩展名)
+    close_up: "PhotoRecord | None" = None  # 主图: 对应的特写图片
+    category: str = ""  # 缺陷类别
+    index: str = ""  # 明细表编号, 如 A1
+
+
+# 解析图片文件名: 主图为 线路_杆号_缺陷_等级, 特写为 线路_杆号_缺陷_等级_特写
+def parse_photo_name(name, path):
+    """Parse a picture file name, return (PhotoRecord, None) or (None, error)"""
+    stem, ext = os.path.splitext(name)
+    if ext.lower() not in IMAGE_EXTENSIONS:
+        return None, "不是图片文件"
+    fields = stem.split("_")
+    close_up = len(fields) == 5 and len(stem.split("_特写")) == 2
+    if len(fields) != 4 and not close_up:
+        return None, NAMING_ERROR
+    if fields[3] not in bug_type_map.values():
+        return None, f"{NAMING_ERROR}: 缺陷等级应为{'/'.join(bug_type_map.values())}"
+    if not close_up:
+        return PhotoRecord(name, path, stem, ext[1:], *fields), None
+    close_up_of = stem.split("_特写")[0]
+    return PhotoRecord(name, path, stem, ext[1:], *fields[:4], close_up_of), None
+
+
+# 扫描图片目录: 边扫描边返回解析好的图片, 名称不规范的文件记录到 errors 中, 不中断扫描
+def scan_images(image_dir, errors):
+    """Yield a PhotoRecord for every picture under image_dir, in os.walk order.
+
+    (path, reason) is appended to errors for every file that is skipped.
+    """
+    subdirs = []
+    with os.scandir(image_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+                continue
+            record, error = parse_photo_name(entry.name, entry.path)
+            if record is None:
+                errors.append((entry.path, error))
+                continue
+            yield record
+    for subdir in subdirs:
+        yield from scan_images(subdir, errors)
 
 
 def insert_row(table, row_index, content):
@@ -632,35 +1217,6 @@ def insert_row(table, row_index, content):
     # set_cell_size(table, 0, 0, 16.84, 0.85)
 
 
-# 处理数据
-def deal(emergencyList, criticalList, commonList, fileName):
-    # 处理数据
-    doc = Document("tpl.docx")
-    tables = doc.tables  # 获取文档中所有表格对象的列表
-    emergency_statis_table_index = get_summary_table_index(doc, 1)
-    critical_statis_table_index = get_summary_table_index(doc, 2)
-    common_statis_table_index = get_summary_table_index(doc, 3)
-
-    deal_one_type_table(doc, emergency_statis_table_index, emergencyList, EMERGENCY)
-    deal_one_type_table(doc, critical_statis_table_index, criticalList, CRITICAL)
-    deal_one_type_table(doc, common_statis_table_index, commonList, COMMON)
-
-    set_detail_statis(tables[emergency_statis_table_index], emergencyList, EMERGENCY)
-    set_detail_statis(tables[critical_statis_table_index], criticalList, CRITICAL)
-    set_detail_statis(tables[common_statis_table_index], commonList, COMMON)
-
-    bug_num_statis(tables[bug_num_table_index])
-    debug_log("缺陷数量统计表 写入完成")
-    bug_type_statis(tables[bug_type_table_index])
-    debug_log("缺陷类别统计表 写入完成")
-
-    if set_total_description(doc):
-        debug_log("缺陷情况总览 写入完成")
-    debug_log("处理结束，正在保存文件...")
-    doc.save(fileName)
-    debug_log("文件保存文件成功")
-
-
 def debug_log(message, log_level=0):
     level_tips = ""
     match log_level:
@@ -669,28 +1225,127 @@ def debug_log(message, log_level=0):
                 return
             level_tips = "[INFO]   "
         case 1:
+            if not warn:
+                return
             level_tips = "\033[33m[WARNING]\033[m"
         case 2:
             level_tips = "\033[31m[ERROR]\033[m  "
-    print(f"{level_tips}{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}")
+    # 被关闭的提示在此之前已经返回, 不会格式化时间
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    # 整行一次写出, 后台线程的提示不会和主线程的混在一行
+    print(f"{level_tips}{now} - {message}\n", end="")
+
+
+# 创建执行图片任务的线程池/进程池
+def create_executor(task_num=0, cpu_bound=True, workers=None):
+    """Create the executor configured by executor_backend and worker_num"""
+    workers = (worker_num if workers is None else workers) or os.cpu_count() or 1
+    backend = executor_backend
+    if backend == "auto":
+        # 缩放图片是CPU密集任务, 使用多进程绕开GIL; 只复制文件时使用多线程即可
+        many_chunks = task_num > chunk_size and workers > 1
+        backend = "process" if cpu_bound and many_chunks else "thread"
+    debug_log(f"使用 {backend} 模式处理图片, 并发数: {workers}")
+    if backend == "process":
+        return ProcessPoolExecutor(workers)
+    return ThreadPoolExecutor(workers)
+
+
+def iter_image_tasks(func, tasks, cpu_bound=True, workers=None, window=0):
+    """Run func for every (pic, args) task in chunks, yielding (pic, result, error).
+
+    tasks may be a generator: each chunk is submitted as soon as it is full, so
+    the work overlaps with producing the tasks (e.g. scanning the directory).
+    Results come in task order. With window > 0 at most that many chunks are
+    submitted ahead of the consumer, a slow consumer holds back the workers.
+    """
+    tasks = iter(tasks)
+    # 先取出 chunk_size+1 个任务, 判断任务是否多于一批, 据此选择线程池或进程池
+    head = list(islice(tasks, chunk_size + 1))
+    if len(head) == 0:
+        return
+    tasks = chain(head, tasks)
+    chunks = iter(lambda: list(islice(tasks, chunk_size)), [])
+    with create_executor(len(head), cpu_bound, workers) as executor:
+        for results in map_window(executor, partial(run_chunk, func), chunks, window):
+            yield from results
 
 
-# 处理exif信息
-def clear_exif(imageList):
+# 按顺序返回结果的 executor.map, 提交的任务不超过 window 个
+def map_window(executor, func, items, window=0):
+    """Yield func(item) for every item, computed by executor, in order.
 
-    def clear(image):
-        debug_log(f"开始清除{image} 的exif信息")
-        f = Image.open(image)  # 你的图片文件
-        f.save(image)  # 替换掉你的图片文件
-        f.close()
-        debug_log(f"清除{image} 的exif信息成功")
+    Unlike executor.map, items are taken lazily: with window > 0 at most that
+    many are submitted ahead of the consumer, so a slow consumer holds back
+    both the producer of items and the workers.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if window > 0 and len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+# 流水线: 后台线程按报告顺序预处理图片, 经过有界队列交给生成明细表的主线程
+class PreparedImageQueue:
+    """Items of a generator, produced by a background thread and read in order.
+
+    The producer blocks while maxsize items are waiting, so a slow consumer
+    holds back the image preparation instead of piling up prepared images.
+    An exception in the producer is raised again by get().
+    """
 
-    executor = ThreadPoolExecutor(ThreadPoolNum)
-    all_tasks = [
-        executor.submit(clear, IMAGE_DIR + "\\" + imageList[i])
-        for i in range(len(imageList))
-    ]
-    wait(all_tasks, return_when=FIRST_EXCEPTION)
+    _DONE = object()
+
+    def __init__(self, items, maxsize):
+        self._queue = queue.Queue(maxsize)
+        self._closed = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._produce, args=(items,), daemon=True)
+        self._thread.start()
+
+    def _produce(self, items):
+        try:
+            for item in items:
+                if not self._put(item):
+                    break
+        except BaseException as e:
+            self._error = e
+        finally:
+            items.close()
+            self._put(self._DONE)
+
+    def _put(self, item):
+        # 消费者已经关闭队列时不再等待
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self):
+        """The next item, None when the producer is done"""
+        item = self._queue.get()
+        if item is self._DONE:
+            self._queue.put(item)
+            if self._error is not None:
+                raise self._error
+            return None
+        return item
+
+    def close(self):
+        """Stop the producer and wait for it"""
+        self._closed.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
 
 
 def timer_input(msg="", default="", time_out=60):
@@ -708,17 +1363,49 @@ def timer_input(msg="", default="", time_out=60):
 
 
 template_file_name = "template.docx"  # 模板文件名称
+debug_template_file = ""  # 调试用: 保存展开后的模板, 如 "tpl.docx", 为空时不保存
 bug_num_table_index = 4  # 缺陷数量表位置
 bug_type_table_index = bug_num_table_index + 1  # 缺陷类别表位置
 statis_number_font = "Times New Roman"  # 统计表数字字体
 is_set_statis_number_size = True
 debug = True  # 是否开启提示
 warn = True  # 是否开启警告信息
-ThreadPoolNum = 10
+executor_backend = "auto"  # 图片处理并发方式: thread / process / auto
+worker_num = 0  # 图片处理并发数, 0表示使用CPU核数
+chunk_size = 8  # 每次提交给线程/进程的图片数量
+pipeline_images = True  # 图片预处理与分析模板, 生成明细表同时进行, 按报告顺序交给明细表
+pipeline_queue_size = 64  # 流水线中已处理, 等待插入文档的图片数量上限
+volume_max_bytes = 0  # 分册: 每册图片的字节数上限, 0表示不按大小分册
+volume_max_tables = 0  # 分册: 每册明细表的数量上限, 0表示不按数量分册
+volume_workers = 0  # 同时生成的分册数量, 0表示CPU核数
+draft_dpi = 20  # 草稿模式缩略图的分辨率
+draft_quality = 50  # 草稿模式缩略图的JPEG压缩质量
+render_shards = 0  # 明细表渲染进程数, 0或1表示在主进程中渲染
+render_chunk_size = 64  # 每个分片渲染的明细表数量
+stream_output = True  # 生成明细表时直接把图片写入报告文件, 不在内存中保留所有图片
+save_trace = False  # 在报告旁保存各阶段耗时和计数 <报告名>_trace.json, 可用 chrome://tracing 查看
+profile_cpu = False  # 用 cProfile 分析生成过程, 结果保存为 <报告名>.prof
+profile_memory = False  # 用 tracemalloc 记录内存分配, 输出峰值和分配最多的代码行
 EMERGENCY = 1
 CRITICAL = 2
 COMMON = 3
 IMAGE_DIR = ".\\pic"
+IMAGE_DAMAGED = "图片文件损坏"  # 损坏的图片, 跳过原因的前缀
+NAMING_ERROR = "图片名称不规范"  # 名称不规范或重名的图片, 跳过原因的前缀
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tif", ".tiff"}
+MAIN_IMAGE_SIZE = (16.4, 12.3)  # 明细表图片尺寸(cm)
+CLOSE_UP_IMAGE_SIZE = (7, 7)  # 明细表特写图片尺寸(cm)
+image_dpi = 150  # 插入图片的目标分辨率
+image_quality = 85  # 插入图片的JPEG压缩质量
+resize_image = True  # 是否缩放插入的图片, 关闭时只无损去除exif信息
+CACHE_DIR = ".\\pic_cache"  # 去除exif信息后的图片目录
+template_cache_dir = ""  # 模板分析结果的缓存目录, 为空时只缓存在内存中
+TEMPLATE_CACHE_VERSION = 2  # 模板缓存格式版本, 修改模板分析逻辑时需要增加
+template_cache = TemplateCache(template_cache_dir)
+incremental = True  # 增量生成: 在报告旁保存图片清单, 重新生成时只处理新增或修改的图片
+IMAGE_MANIFEST_VERSION = 1  # 图片清单格式版本
+image_cache_dir = ""  # 多份报告共用的图片缓存目录, 为空时每份报告使用自己的 _cache 目录
+image_cache_size = 2 << 30  # 图片缓存容量(字节), 超出时删除最久未使用的图片, 0表示不限制
 
 
 def get_path():
@@ -729,38 +1416,1179 @@ def get_path():
     get_path()
 
 
-def main():
-    global IMAGE_DIR
-    debug_log(
-        f"请确认要处理的文件在\033[32m{os.getcwd()}{IMAGE_DIR[1:]}\033[m目录下",
-        1,
-    )
-    # custom_path = timer_input("\n<是>输入:1\n<否>输入:2\n如需选择其他路径,输入:3")
-    # match custom_path:
-    #     # case "1":
+# 报告生成器: 每份报告的数据都保存在各自的对象中, 同一进程可以同时生成多份报告
+class ReportBuilder:
+    """Generate one report: scan() the images, build() the document, then save() it"""
+
+    def __init__(
+        self,
+        image_dir=None,
+        template=None,
+        quality=None,
+        workers=None,
+        cache=None,
+        manifest=None,
+        image_cache=None,
+        draft=None,
+        instrumentation=None,
+    ):
+        self.image_dir = IMAGE_DIR if image_dir is None else image_dir
+        # 模板文件名, 或模板文件的内容(bytes)
+        self.template = template_file_name if template is None else template
+        self.template_cache = template_cache if cache is None else cache
+        self.image_quality = image_quality if quality is None else quality
+        self.worker_num = worker_num if workers is None else workers
+        self.image_dpi = image_dpi
+        self.resize_image = resize_image
+        # 草稿模式: "thumbnail" 插入很小的缩略图, "none" 所有位置都插入同一张占位图片
+        self.draft = draft
+        self.placeholder = None
+        if draft == "thumbnail":
+            self.image_dpi = draft_dpi
+            self.image_quality = draft_quality
+            self.resize_image = True
+        elif draft == "none":
+            self.placeholder = placeholder_image()
+        self.cache_dir = CACHE_DIR
+        self.manifest = manifest  # ImageManifest, 为空时不做增量处理
+        # 预处理后的图片缓存, 增量生成时默认使用清单所在的目录
+        if image_cache is None and manifest is not None:
+            image_cache = ImageCache(manifest.cache_dir, image_cache_size)
+        self.image_cache = image_cache
+        self.shards = render_shards
+        # 本报告的各阶段耗时和计数
+        self.instrumentation = instrumentation or Instrumentation()
+        self.doc = None
+        self.writer = None  # DocxStreamWriter, build(stream_to=...) 时边生成边写入
+        self.emergency_list = []
+        self.critical_list = []
+        self.common_list = []
+
+        self.statistics = None  # DefectStatistics, scan() 之后可用
+        self.records = {}  # 文件名 -> PhotoRecord, 包括特写图片
+        self.prepared_image_map = {}
+        self.image_stats = {}
+        self.probes = {}  # 文件名 -> ImageProbe, 扫描时读取的文件头
+        self.pass_through = set()  # 文件头符合条件, 可能直接插入原文件的图片
+        self.prepared = False  # scan() 时是否已经预处理了图片
+        self.prepare_total = 0
+        self.prepare_reused = 0
+        self.prepare_started = 0
+        self.pipeline = None  # PreparedImageQueue, 边预处理图片边生成文档
+        self.pending_images = set()  # 流水线中还没有取出的图片
+        self.volume = None  # 分册时本册明细表中的缺陷 {缺陷等级: [PhotoRecord]}
+        self.volume_notes = {}  # 分册时本册没有的缺陷等级 -> 明细表中的说明
+
+    def scan(self, prepare=True, probe=True):
+        """Classify and prepare the images, return False when there is nothing to build.
+
+        With prepare=False the images are only classified, enough for statistics;
+        build() then prepares them while it builds the document. With probe=False
+        the picture headers are not read either, for when nothing is embedded.
+        """
+        if not os.path.isdir(self.image_dir):
+            debug_log(f"图片目录 {self.image_dir} 不存在", 2)
+            return False
+        # 不插入图片的草稿不需要预处理, 也不需要读取文件头
+        if self.placeholder is not None:
+            prepare = probe = False
+        images = self.get_images(self.image_dir, prepare, probe)
+        self.prepared = prepare or self.placeholder is not None
+        self.emergency_list, self.critical_list, self.common_list = images
+        with self.instrumentation.stage("statistics"):
+            self.statistics = DefectStatistics(
+                chain(*images), bug_classifier.categories(), bug_type_map.values()
+            )
+        if sum(len(image_list) for image_list in images) == 0:
+            debug_log(
+                f"{self.image_dir} 未找到任何图片",
+                1,
+            )
+            return False
+        return True
+
+    # 生成报告: 模板展开和数据填充在同一个文档对象上完成, 中间不保存和重新读取
+    @timed()
+    def build(self, stream_to=None):
+        """Build the report from the template in a single in-memory pass.
+
+        With stream_to (the output file name) the pictures are written into the
+        output while the tables are built, and save() writes the rest.
+        Images that scan() did not prepare are prepared in the background at the
+        same time, see start_pipeline().
+        """
+        if not self.prepared:
+            self.start_pipeline()
+        done = False
+        try:
+            done = self.build_document(stream_to)
+        finally:
+            if self.pipeline is not None:
+                self.finish_pipeline(done)
+        return done
+
+    def build_document(self, stream_to=None):
+        # 模板缓存由多份报告共用, 读取和分析模板的时间计入本报告
+        with self.instrumentation.stage("analyse_template"):
+            cached = self.template_cache.get(self.template)
+        if cached is None:
+            return False
+        # 复制一份分析过的模板, 相当于打开word软件，新建一个文件
+        doc, index = cached.new_document()
+        with self.instrumentation.stage("get_template"):
+            expanded = get_template(
+                index,
+                self.emergency_list,
+                self.critical_list,
+                self.common_list,
+                cached.row_prototypes,
+            )
+        if not expanded:
+            return False
+        if len(debug_template_file) > 0:
+            doc.save(debug_template_file)
+            debug_log(f"展开后的模板已保存到 {debug_template_file}")
+        if stream_to is not None:
+            self.writer = DocxStreamWriter(stream_to)
+        try:
+            self.deal(doc, index, cached.detail_templates)
+        except BaseException:
+            if self.writer is not None:
+                self.writer.abort()
+                self.writer = None
+            raise
+        self.doc = doc
+        return True
+
+    @timed()
+    def save(self, fileName):
+        debug_log("处理结束，正在保存文件...")
+        if self.writer is None:
+            self.doc.save(fileName)
+        else:
+            # 图片已经写入, 只需写入其余部分
+            writer, self.writer = self.writer, None
+            try:
+                writer.finish(self.doc, fileName)
+            except BaseException:
+                writer.abort()
+                raise
+        debug_log("文件保存文件成功")
+
+    # 获取待处理的图片: 边扫描边把图片交给线程池/进程池预处理
+    @timed()
+    def get_images(self, image_dir="", prepare=True, probe=True):
+        """Image Classification"""
+        image_list = []
+        close_ups = {}
+        errors = []
+        # 扫描和读取文件头的时间, 边扫描边预处理时不计入 prepare_images
+        pics = self.instrumentation.timed_iter(
+            "scan_images",
+            self.collect_images(image_dir, image_list, close_ups, errors, probe),
+        )
+        if prepare:
+            self.prepare_images(pics)
+        else:
+            for _ in pics:
+                pass
+        self.report_naming_errors(errors)
+        self.instrumentation.count("images_scanned", len(self.records))
+
+        common_list = []
+        critical_list = []
+        emergency_list = []
+        for record in image_list:
+            match record.level:
+                case "危急":
+                    emergency_list.append(record)
+                case "严重":
+                    critical_list.append(record)
+                case "一般":
+                    common_list.append(record)
+
+        # 关联特写图片, 确定缺陷类别和明细表编号
+        for bug_type, records in (
+            (EMERGENCY, emergency_list),
+            (CRITICAL, critical_list),
+            (COMMON, common_list),
+        ):
+            for i, record in enumerate(records):
+                records[i] = replace(
+                    record,
+                    close_up=close_ups.get(record.stem),
+                    category=get_bug_type(record.reason),
+                    index=f"{bug_index_prefix[bug_type]}{i + 1}",
+                )
+        return emergency_list, critical_list, common_list
+
+    def collect_images(self, image_dir, image_list, close_ups, errors, probe=True):
+        """Record the scanned pictures, yielding (pic, slot size) to prepare.
+
+        With probe, every picture's header is read; files that cannot be read are
+        skipped here instead of failing when they are embedded. The pictures are known by
+        their file names, so a name found again in another subdirectory is skipped
+        as a naming error.
+        """
+        for record in scan_images(image_dir, errors):
+            if record.name in self.records:
+                first = self.records[record.name].path
+                errors.append((record.path, f"{NAMING_ERROR}: 与 {first} 重名"))
+                continue
+            try:
+                if probe:
+                    self.probes[record.name] = probe_image(record.path)
+            except ValueError as e:
+                errors.append((record.path, f"{IMAGE_DAMAGED}: {e}"))
+                continue
+            self.records[record.name] = record
+            if len(record.close_up_of) > 0:
+                close_ups[record.close_up_of] = record
+                yield record.name, CLOSE_UP_IMAGE_SIZE
+                continue
+            image_list.append(record)
+            yield record.name, MAIN_IMAGE_SIZE
+
+    # 名称不规范和损坏的文件一起报告, 不中断生成
+    def report_naming_errors(self, errors):
+        naming_errors = [(path, e) for path, e in errors if e.startswith(NAMING_ERROR)]
+        damaged = [(path, e) for path, e in errors if e.startswith(IMAGE_DAMAGED)]
+        other_files = [
+            path
+            for path, error in errors
+            if not error.startswith((NAMING_ERROR, IMAGE_DAMAGED))
+        ]
+        if len(naming_errors) > 0:
+            debug_log(f"{len(naming_errors)}张图片名称不规范, 已跳过:", 2)
+            for path, error in naming_errors:
+                detail = error[len(NAMING_ERROR) + 2 :]
+                debug_log(f"不规范的图片为：\033[35m{path}\033[m {detail}", 2)
+        if len(damaged) > 0:
+            debug_log(f"{len(damaged)}张图片无法读取, 已跳过:", 2)
+            for path, error in damaged:
+                debug_log(f"\033[35m{path}\033[m {error}", 2)
+        if len(other_files) > 0:
+            debug_log(f"跳过{len(other_files)}个不是图片的文件: {', '.join(other_files)}", 1)
+
+    # 预处理图片: 按插入位置的尺寸缩放并重新压缩, 同时去除exif信息
+    # 不缩放时只无损去除exif信息, 结果写入缓存目录, 不修改原图
+    @timed()
+    def prepare_images(self, pics):
+        """Prepare every image once, before it is embedded.
+
+        pics yields (pic, slot size) pairs, possibly while the directory is still
+        being scanned; the images go to the worker pool as they come.
+        """
+        for pic, result, error in self.iter_prepared_images(pics):
+            self.accept_prepared_image(pic, result, error)
+        self.finish_prepare()
+
+    def iter_prepared_images(self, pics, window=0):
+        """Yield (pic, result, error) for every (pic, slot size) in pics, in order.
+
+        Unchanged images found in the manifest are not prepared again, images
+        that cannot be prepared have no result and are embedded as they are.
+        window limits the chunks waiting in the worker pool, see iter_image_tasks.
+        """
+        cache = self.image_cache
+        # 文件修改时间的精度比 time.time() 低, 留出余量, 避免清理掉本次用到的图片
+        self.prepare_started = time.time() - 2
+        if cache is not None:
+            os.makedirs(cache.cache_dir, exist_ok=True)
+        elif not self.resize_image:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        if self.resize_image:
+            debug_log("开始预处理图片")
+            # 使用图片缓存时结果写入缓存目录, 否则保存在内存中
+            func = prepare_image if cache is None else prepare_image_file
+        else:
+            debug_log("开始清除图片的exif信息")
+            func = strip_image_metadata if cache is None else strip_image_file
+        # 可以直接插入的图片在任务中确认文件完整
+        func = partial(prepare_unless_intact, func)
+        # 不交给线程池/进程池的图片按原来的顺序插在处理结果之间, None 表示线程池中的任务
+        order = deque()
+
+        def tasks():
+            for pic, size in pics:
+                self.prepare_total += 1
+                reused = None
+                if cache is not None:
+                    reused = self.reusable_prepared_image(pic, size)
+                if reused is not None:
+                    self.prepare_reused += 1
+                    order.append((pic, reused, None))
+                    continue
+                task = self.image_task(pic, size)
+                if task is None:
+                    order.append((pic, None, None))
+                    continue
+                order.append(None)
+                yield pic, task
+
+        for item in iter_image_tasks(
+            func, tasks(), self.resize_image, self.worker_num, window
+        ):
+            while order[0] is not None:
+                yield order.popleft()
+            order.popleft()
+            yield item
+        yield from order
+
+    def accept_prepared_image(self, pic, result, error):
+        if error is not None:
+            debug_log(f"图片处理失败: \033[35m{pic}\033[m {error}", 2)
+            return
+        if result is None:
+            if pic in self.pass_through:
+                self.instrumentation.count("images_passed_through")
+            return
+        if self.image_cache is None:
+            self.prepared_image_map[pic] = result
+        else:
+            digest, name, hit = result
+            self.image_cache.count(hit)
+            self.record_prepared_image(pic, digest, name)
+        debug_log(f"图片 {pic} 处理完成")
+
+    def finish_prepare(self):
+        cache = self.image_cache
+        reused = self.prepare_reused
+        self.instrumentation.count("images_prepared", len(self.prepared_image_map) - reused)
+        self.instrumentation.count("images_reused", reused)
+        if reused > 0:
+            debug_log(f"{reused}张图片未修改, 使用上次的预处理结果")
+        if cache is not None:
+            if self.manifest is not None:
+                # 报告自己的缓存目录中, 不再使用的图片直接删除
+                self.manifest.save(cache.cache_dir == self.manifest.cache_dir)
+            removed = cache.evict(keep_after=self.prepare_started)
+            debug_log(
+                f"图片缓存命中{cache.hits}张, 未命中{cache.misses}张, 清理{removed}个文件"
+            )
+        debug_log(
+            f"图片预处理完成, 成功{len(self.prepared_image_map)}/{self.prepare_total}张"
+        )
+
+    def image_task(self, pic, size):
+        """Arguments of prepare_unless_intact() for one image, None to embed it as is"""
+        image_path = self.records[pic].path
+        cache = self.image_cache
+        pass_through = self.passes_through(pic, size)
+        if pass_through:
+            self.pass_through.add(pic)
+        if self.resize_image:
+            extra = () if cache is None else (cache,)
+            return (
+                pass_through,
+                image_path,
+                *extra,
+                *size,
+                self.image_dpi,
+                self.image_quality,
+            )
+        # 只能无损去除JPEG图片的exif信息
+        if os.path.splitext(pic)[1].lower() not in (".jpg", ".jpeg"):
+            return None
+        if cache is None:
+            return (pass_through, image_path, os.path.join(self.cache_dir, pic))
+        return (pass_through, image_path, cache)
+
+    # 已经足够小, 没有元数据的图片直接插入原文件, 不解码也不复制
+    # 文件是否完整, 末尾有没有附加内容要读完整个文件, 在任务中检查
+    def passes_through(self, pic, size):
+        probe = self.probes.get(pic)
+        if probe is None:
+            return False
+        if self.resize_image:
+            return fits_slot(probe, *size, self.image_dpi)
+        return probe.orientation == 1 and not probe.metadata and probe.recognized
+
+    # 增量生成: 大小和修改时间都没有变化的图片, 直接使用上次的预处理结果
+    def reusable_prepared_image(self, pic, size):
+        """(digest, cache file name, True) of an unchanged image in the manifest, or None"""
+        path = os.path.abspath(self.records[pic].path)
+        stat = os.stat(path)
+        self.image_stats[pic] = (path, stat)
+        entry = None
+        if self.manifest is not None:
+            entry = self.manifest.lookup(pic, path, stat)
+        if entry is None or entry["cache"] != self.prepared_file_name(
+            entry["sha256"], size
+        ):
+            return None
+        if self.image_cache.get(entry["cache"]) is None:
+            return None
+        return entry["sha256"], entry["cache"], True
+
+    def prepared_file_name(self, digest, size):
+        """Cache file name of an image with the current settings"""
+        if self.resize_image:
+            return prepared_file_name(digest, *size, self.image_dpi, self.image_quality)
+        return stripped_file_name(digest)
+
+    def record_prepared_image(self, pic, digest, name):
+        if self.manifest is not None:
+            path, stat = self.image_stats[pic]
+            record = self.records[pic]
+            fields = [record.route, record.tower, record.reason, record.level]
+            self.manifest.record(pic, path, stat, digest, fields, name)
+        self.prepared_image_map[pic] = self.image_cache.path(name)
+
+    # 处理数据
+    def deal(self, doc, index, detail_templates):
+        emergencyList = self.emergency_list
+        criticalList = self.critical_list
+        commonList = self.common_list
+        # 分册时明细表只包含本册的缺陷, 汇总表和统计表始终完整
+        details = self.volume or {
+            EMERGENCY: emergencyList,
+            CRITICAL: criticalList,
+            COMMON: commonList,
+        }
+        tables = index.tables  # 获取文档中所有表格对象的列表
+        registry = MediaRegistry(doc.part, self.writer, self.instrumentation)
+        shape_ids = count(doc.part.next_id)
+        # 分片渲染: shards > 1 时明细表在多个进程中渲染, 按顺序合并到文档
+        with (
+            ProcessPoolExecutor(self.shards) if self.shards > 1 else nullcontext()
+        ) as executor:
+            # 每个进程最多两个分片在渲染或等待合并, 不一次取出全部图片
+            render = map
+            if executor is not None:
+                render = partial(map_window, executor, window=2 * self.shards)
+            for bug_type, image_list in details.items():
+                self.deal_one_type_table(
+                    index,
+                    detail_templates,
+                    index.summary_table_index(bug_type),
+                    image_list,
+                    bug_type,
+                    render,
+                    registry,
+                    shape_ids,
+                )
+        emergency_statis_table_index = index.summary_table_index(EMERGENCY)
+        critical_statis_table_index = index.summary_table_index(CRITICAL)
+        common_statis_table_index = index.summary_table_index(COMMON)
+
+        self.set_detail_statis(tables[emergency_statis_table_index], emergencyList, EMERGENCY)
+        self.set_detail_statis(tables[critical_statis_table_index], criticalList, CRITICAL)
+        self.set_detail_statis(tables[common_statis_table_index], commonList, COMMON)
+
+        self.bug_num_statis(tables[bug_num_table_index], self.statistics)
+        debug_log("缺陷数量统计表 写入完成")
+        self.bug_type_statis(tables[bug_type_table_index], self.statistics)
+        debug_log("缺陷类别统计表 写入完成")
+
+        if self.set_total_description(index, self.statistics):
+            debug_log("缺陷情况总览 写入完成")
+
+    @timed()
+    def deal_one_type_table(
+        self,
+        index,
+        detail_templates,
+        table_index,
+        iamge_list,
+        bug_type,
+        render,
+        registry,
+        shape_ids,
+    ):
+        debug_log(f"开始处理 {bug_type_map.get(bug_type,'')}明细表")
+        # 明细表紧跟在同等级的汇总表之后
+        original = index.tables[table_index + 1]
+        if len(iamge_list) == 0:
+            note = self.volume_notes.get(bug_type, bug_index_prefix[bug_type] + str(1))
+            insert_row(original, 0, [note])
+            return
+        copy_template, last_template = detail_templates[bug_type]
+        self.instrumentation.count("tables_cloned", len(iamge_list) - 1)
+        last = len(iamge_list) - 1
+
+        # 每个缺陷一个表格, 后面加一个分页符; 最后一个缺陷替换模板中原有的明细表
+        # 逐个分片取出图片, 流水线中的图片处理好一个分片就生成一个分片
+        def chunks():
+            for start in range(0, len(iamge_list), render_chunk_size):
+                yield [
+                    (
+                        copy_template if i < last else last_template,
+                        record,
+                        self.image_sources(record),
+                        i < last,
+                    )
+                    for i, record in enumerate(
+                        iamge_list[start : start + render_chunk_size], start
+                    )
+                ]
+
+        elements = []
+        for xml, images in render(render_detail_chunk, chunks()):
+            elements += merge_detail_chunk(xml, images, registry, shape_ids)
+        # 依次插入到标题之后
+        anchor = index.paragraph(f"{bug_type_map[bug_type]}缺陷明细表")._p
+        for element in elements[:-1]:
+            anchor.addnext(element)
+            anchor = element
+        tbl = elements[-1]
+        original._tbl.addprevious(tbl)
+        original._tbl.getparent().remove(original._tbl)
+        new_tables = [
+            Table(element, original._parent)
+            for element in elements[:-1]
+            if element.tag == qn("w:tbl")
+        ]
+        index.insert_detail_tables(table_index + 1, new_tables)
+        index.tables[table_index + len(iamge_list)] = Table(tbl, original._parent)
+        debug_log(f"{bug_type_map.get(bug_type,'')}明细表 处理完成, 共{len(iamge_list)}个")
+
+    def image_sources(self, record):
+        """The picture and close-up to embed: prepared bytes or file paths"""
+        # 优先使用预处理后的图片, 预处理失败时使用原图
+        sources = [self.prepared_source(record), None]
+        if record.close_up is not None:
+            sources[1] = self.prepared_source(record.close_up)
+        return tuple(sources)
+
+    def prepared_source(self, record):
+        if self.placeholder is not None:
+            return self.placeholder
+        if record.name in self.pending_images:
+            self.wait_prepared_image(record.name)
+        source = self.prepared_image_map.get(record.name, record.path)
+        if self.image_cache is not None and isinstance(source, str):
+            source = self.cached_source(record, source)
+        return source
+
+    # 共用的图片缓存可能被其他报告清理: 插入前再标记为最近使用, 已被删除时重新处理
+    def cached_source(self, record, path):
+        """Path of the cached picture, prepared again if another run evicted it"""
+        cache = self.image_cache
+        if path == record.path or cache.get(os.path.basename(path)) is not None:
+            return path
+        debug_log(f"图片 {record.name} 的缓存已被清理, 重新处理", 1)
+        size = CLOSE_UP_IMAGE_SIZE if record.close_up_of else MAIN_IMAGE_SIZE
+        try:
+            if self.resize_image:
+                _, name, _ = prepare_image_file(
+                    record.path, cache, *size, self.image_dpi, self.image_quality
+                )
+            else:
+                _, name, _ = strip_image_file(record.path, cache)
+        except Exception as e:
+            debug_log(f"图片处理失败: \033[35m{record.name}\033[m {e}", 2)
+            return record.path
+        path = cache.path(name)
+        self.prepared_image_map[record.name] = path
+        return path
+
+    # 流水线: 扫描之后在后台按插入文档的顺序预处理图片, 同时分析模板, 展开表格
+    def start_pipeline(self):
+        """Start preparing the embedded images in report order in the background.
+
+        At most pipeline_queue_size prepared images wait for the detail tables,
+        plus two chunks per worker in the pool.
+        """
+        pics = []
+        for record in chain(self.emergency_list, self.critical_list, self.common_list):
+            pics.append((record.name, MAIN_IMAGE_SIZE))
+            if record.close_up is not None:
+                pics.append((record.close_up.name, CLOSE_UP_IMAGE_SIZE))
+        self.pending_images = {pic for pic, _ in pics}
+        window = 2 * (self.worker_num or os.cpu_count() or 1)
+        self.pipeline = PreparedImageQueue(
+            self.iter_prepared_images(pics, window), pipeline_queue_size
+        )
+
+    def wait_prepared_image(self, pic):
+        """Take prepared images from the pipeline until pic is ready"""
+        with self.instrumentation.stage("wait_prepared_image"):
+            while pic in self.pending_images:
+                item = self.pipeline.get()
+                if item is None:
+                    break
+                self.pending_images.discard(item[0])
+                self.accept_prepared_image(*item)
+
+    def finish_pipeline(self, done):
+        """Stop the pipeline; after a successful build, record what was prepared"""
+        try:
+            while done:
+                item = self.pipeline.get()
+                if item is None:
+                    break
+                self.accept_prepared_image(*item)
+        finally:
+            self.pipeline.close()
+            self.pipeline = None
+            self.pending_images = set()
+        if done:
+            self.finish_prepare()
+
+    # 分册: 按报告顺序把缺陷分到几册中, 每册的图片字节数和明细表数量不超过预算
+    def plan_volumes(self, max_bytes=0, max_tables=0):
+        """Split the defects into volumes, a list of {bug_type: [PhotoRecord]}.
+
+        A volume is closed before a defect would take it over max_bytes of
+        embedded pictures or max_tables detail tables (0: no limit); a defect
+        over the budget on its own gets a volume of its own. The sizes are those
+        of the prepared pictures, so scan() must have prepared them.
+        """
+        volumes = []
+        volume = None
+        size = tables = 0
+        for bug_type, records in (
+            (EMERGENCY, self.emergency_list),
+            (CRITICAL, self.critical_list),
+            (COMMON, self.common_list),
+        ):
+            for record in records:
+                record_size = self.embedded_size(record)
+                full = volume is not None and (
+                    (max_tables > 0 and tables + 1 > max_tables)
+                    or (max_bytes > 0 and size + record_size > max_bytes)
+                )
+                if volume is None or full:
+                    volume = {EMERGENCY: [], CRITICAL: [], COMMON: []}
+                    volumes.append(volume)
+                    size = tables = 0
+                volume[bug_type].append(record)
+                size += record_size
+                tables += 1
+        return volumes
+
+    def embedded_size(self, record):
+        """Bytes of the picture and close-up embedded for a defect"""
+        size = 0
+        for source in self.image_sources(record):
+            if isinstance(source, bytes):
+                size += len(source)
+            elif source is not None:
+                size += os.path.getsize(source)
+        return size
+
+    @timed()
+    def build_volumes(self, file_name, volumes):
+        """Build and save every volume, in parallel processes; return the file names.
+
+        Volume 1 holds the complete summary and statistics tables, like every
+        other volume; the detail tables are split between the volumes.
+        """
+        files = [volume_path(file_name, n) for n in range(1, len(volumes) + 1)]
+        jobs = []
+        for volume, volume_file in zip(volumes, files):
+            notes = {}
+            for bug_type in volume:
+                numbers = [
+                    str(n) for n, other in enumerate(volumes, 1) if len(other[bug_type]) > 0
+                ]
+                if len(volume[bug_type]) == 0 and len(numbers) > 0:
+                    notes[bug_type] = f"见第{'、'.join(numbers)}册"
+            # 只传递本册用到的图片
+            pictures = [
+                picture
+                for record in chain(*volume.values())
+                for picture in (record, record.close_up)
+                if picture is not None
+            ]
+            prepared = {
+                picture.name: self.prepared_image_map[picture.name]
+                for picture in pictures
+                if picture.name in self.prepared_image_map
+            }
+            jobs.append((volume_file, volume, notes, prepared))
+        # 各册用到的缓存图片被清理时, 在生成分册的进程中按相同的参数重新处理
+        settings = {
+            "image_cache": self.image_cache,
+            "image_dpi": self.image_dpi,
+            "image_quality": self.image_quality,
+            "resize_image": self.resize_image,
+        }
+        lists = (self.emergency_list, self.critical_list, self.common_list)
+        workers = min(len(jobs), volume_workers or os.cpu_count() or 1)
+        debug_log(f"报告分为{len(jobs)}册, 使用{workers}个进程生成")
+        config = {"debug": debug, "warn": warn, "stream_output": stream_output}
+        with ProcessPoolExecutor(
+            workers, initializer=set_config, initargs=(config,)
+        ) as executor:
+            futures = [
+                executor.submit(
+                    build_volume, self.template, lists, self.statistics, *job, settings
+                )
+                for job in jobs
+            ]
+            if not all(future.result() for future in futures):
+                return None
+        return files
+
+    # statis_add_table 汇总数据写入
+    @timed()
+    def set_detail_statis(self, table, images, bug_type):
+        debug_log(f"开始处理 {bug_type_map.get(bug_type,'')}缺陷汇总表")
+        rows = []
+        c = 1
+        for record in images:
+            rows.append(
+                (str(c), record.stem[:-3], record.category, record.level, record.index)
+            )
+            c += 1
+        write_table_rows(table, rows, 1)
+        debug_log(f"{bug_type_map.get(bug_type,'')}缺陷汇总表 写入完成")
+
+    # 缺陷数量统计表
+    @timed()
+    def bug_num_statis(self, table, statistics):
+        bugLevelCountMap = statistics.by_category()
+        if len(bugLevelCountMap) == 0:
+            return
+        col = 0
+        for key in table.rows[0].cells:
+            count = bugLevelCountMap.get(key.text, 0)
+            if count > 0:
+                table.cell(1, col).text = str(count)
+                table.cell(1, col).paragraphs[0].runs[
+                    0
+                ].font.name = statis_number_font
+                if is_set_statis_number_size:
+                    copy_cell_font_size(table.cell(1, col), table.cell(0, col))
+                cell_set_center(table.cell(1, col))
+            col += 1
+
+    # 缺陷类别统计表
+    @timed()
+    def bug_type_statis(self, table, statistics):
+        row = 0
+        for rows in table.rows:
+            bugLevelCountMap = statistics.by_category(rows.cells[0].text)
+            if len(bugLevelCountMap) > 0 or row >= 2:
+                col = 0
+                for key in table.rows[1].cells:
+                    count = bugLevelCountMap.get(key.text, 0)
+                    if count > 0 or col >= 1:
+                        table.cell(row, col).text = str(count)
+                        table.cell(row, col).paragraphs[0].runs[
+                            0
+                        ].font.name = statis_number_font
+                        if is_set_statis_number_size:
+                            copy_cell_font_size(
+                                table.cell(row, col), table.cell(1, col)
+                            )
+
+                        cell_set_center(table.cell(row, col))
+                    col += 1
+            row += 1
+
+    # 缺陷情况总览
+    @timed()
+    def set_total_description(self, index, statistics):
+        para = index.paragraph("本次现场巡检")
+        if para is None:
+            debug_log(" 定位缺陷情况总览模块失败......", 2)
+            return False
+        tpl = para.text
+        font_size = para.runs[0].font.size
+        content = tpl.format(
+            total_bug=statistics.count(),
+            weiji_bug=statistics.count(level="危急"),
+            yanzhong_bug=statistics.count(level="严重"),
+            yiban_bug=statistics.count(level="一般"),
+            bileiqi_bug=statistics.count("避雷器"),
+            bianyaqi_bug=statistics.count("变压器"),
+            daodixian_bug=statistics.count("导地线"),
+            fushu_bug=statistics.count("附属设施"),
+            jichu_bug=statistics.count("基础"),
+            jinjv_bug=statistics.count("金具"),
+            jueyuanzi_bug=statistics.count("绝缘子"),
+            tongdao_bug=statistics.count("通道"),
+        )
+        debug_log(f"缺陷情况总览文字: {content}")
+        para.text = content
+        para.runs[0].font.size = font_size
+        return True
+
+
+# 缺陷统计文件保存在报告旁边
+def stats_path(file_name, stats_format):
+    return f"{os.path.splitext(file_name)[0]}_统计.{stats_format}"
+
+
+# 分册的文件名: res.docx -> res_part1.docx
+def volume_path(file_name, number):
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}_part{number}{ext}"
+
 
-    #     case "2":
-    #         return
-    #     case "3":
-    #         IMAGE_DIR = get_path()
+# 草稿保存在正式报告旁边: res.docx -> res_草稿.docx
+def draft_path(file_name):
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}_草稿{ext}"
 
-    tmp_name = timer_input(
-        "\033[32m待生成的文件名称(按回车确认,ctrl+c取消):\033[m", default="res"
+
+# 性能统计文件和 cProfile 结果保存在报告旁边
+def trace_path(file_name):
+    return f"{os.path.splitext(file_name)[0]}_trace.json"
+
+
+def profile_path(file_name):
+    return f"{os.path.splitext(file_name)[0]}.prof"
+
+
+def set_config(config):
+    """Apply the settings of the main process in a worker process"""
+    globals().update(config)
+
+
+# 在独立的进程中生成一册, 图片已经预处理好
+def build_volume(
+    template, lists, statistics, file_name, volume, notes, prepared, settings
+):
+    """Build and save one volume of a report, return False if it failed.
+
+    settings holds the image cache and preparing options of the main builder.
+    """
+    builder = ReportBuilder(template=template)
+    for name, value in settings.items():
+        setattr(builder, name, value)
+    builder.emergency_list, builder.critical_list, builder.common_list = lists
+    builder.statistics = statistics
+    builder.prepared = True
+    builder.prepared_image_map = prepared
+    builder.volume = volume
+    builder.volume_notes = notes
+    if not builder.build(stream_to=file_name if stream_output else None):
+        return False
+    builder.save(file_name)
+    return True
+
+
+# 草稿: 与正式报告相同的模板展开, 编号和统计, 图片只用缩略图或占位图片
+def build_draft(
+    image_dir, file_name, template_data, stats_format, draft, instrumentation=None
+):
+    """Build a preview of the report as <name>_草稿.docx.
+
+    Thumbnails are kept in the report's cache directory under their own names,
+    next to the full-size pictures, and reused by the next draft; the image
+    manifest of the final report is left alone.
+    """
+    image_cache = None
+    if draft == "thumbnail":
+        cache_dir = image_cache_dir or os.path.dirname(manifest_path(file_name)) or "."
+        image_cache = ImageCache(cache_dir, image_cache_size)
+    builder = ReportBuilder(
+        image_dir,
+        template_data,
+        image_cache=image_cache,
+        draft=draft,
+        instrumentation=instrumentation,
     )
-    file_name = f"{tmp_name}.docx"
-    emergency_list, critical_list, common_list = get_images(IMAGE_DIR)
-    if len(common_list) + len(critical_list) + len(emergency_list) == 0:
-        debug_log(
-            f"未找到任何图片,结束运行",
-            1,
+    if not builder.scan(prepare=not pipeline_images):
+        return False
+    draft_file = draft_path(file_name)
+    if not builder.build(stream_to=draft_file if stream_output else None):
+        return False
+    builder.save(draft_file)
+    if stats_format is not None:
+        builder.statistics.save(stats_path(file_name, stats_format))
+    debug_log(f"请查看草稿 \033[32m{draft_file}\033[m 文件")
+    return True
+
+
+# 可选的性能分析: cProfile 的结果保存到文件, tracemalloc 输出内存峰值和分配最多的代码行
+@contextmanager
+def profiling(file_name):
+    profiler = None
+    if profile_cpu:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if profile_memory:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path(file_name))
+            debug_log(f"cProfile 结果已保存到 {profile_path(file_name)}")
+        if profile_memory:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            debug_log(f"Python内存分配峰值 {peak / (1 << 20):.1f}MB, 分配最多的代码行:")
+            for stat in snapshot.statistics("lineno")[:10]:
+                debug_log(f"    {stat}")
+
+
+# 生成一份报告
+def run_report(
+    image_dir,
+    file_name,
+    template_data,
+    reuse=True,
+    stats_format=None,
+    stats_only=False,
+    draft=None,
+):
+    """Generate one report from image_dir; template_data is the template file content.
+
+    stats_format ("json"/"csv") also exports the defect statistics; with
+    stats_only the images are only classified and no document is built.
+    draft ("thumbnail"/"none") builds a quick preview next to file_name.
+    The stage timings are logged afterwards, see Instrumentation.
+    """
+    instrumentation = Instrumentation(save_trace)
+    with profiling(file_name):
+        done = _run_report(
+            image_dir,
+            file_name,
+            template_data,
+            reuse,
+            stats_format,
+            stats_only,
+            draft,
+            instrumentation,
         )
-        return
-    if get_template(emergency_list, critical_list, common_list, template_file_name):
-        deal(emergency_list, critical_list, common_list, file_name)
-        debug_log(f"请查看 \033[32m{file_name}\033[m 文件")
+    if debug:
+        debug_log("各阶段耗时(秒), 嵌套的阶段包含在外层阶段中:")
+        for line in instrumentation.summary():
+            debug_log(f"    {line}")
+    if save_trace:
+        instrumentation.save(trace_path(file_name))
+        debug_log(f"性能统计已保存到 {trace_path(file_name)}")
+    return done
+
+
+def _run_report(
+    image_dir,
+    file_name,
+    template_data,
+    reuse,
+    stats_format,
+    stats_only,
+    draft,
+    instrumentation,
+):
+    # 报告, 统计和草稿都保存在报告所在的目录中
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+    if stats_only:
+        builder = ReportBuilder(
+            image_dir, template_data, instrumentation=instrumentation
+        )
+        if not builder.scan(prepare=False, probe=False):
+            return False
+        stats_file = stats_path(file_name, stats_format or "json")
+        builder.statistics.save(stats_file)
+        debug_log(f"请查看 \033[32m{stats_file}\033[m 文件")
+        return True
+    if draft is not None:
+        return build_draft(
+            image_dir, file_name, template_data, stats_format, draft, instrumentation
+        )
+    manifest = None
+    if incremental:
+        manifest = ImageManifest(manifest_path(file_name), reuse)
+    image_cache = None
+    if len(image_cache_dir) > 0:
+        image_cache = ImageCache(image_cache_dir, image_cache_size)
+    builder = ReportBuilder(
+        image_dir,
+        template_data,
+        manifest=manifest,
+        image_cache=image_cache,
+        instrumentation=instrumentation,
+    )
+    split = volume_max_bytes > 0 or volume_max_tables > 0
+    # 分册需要预处理后的图片大小, 不使用流水线
+    if not builder.scan(prepare=split or not pipeline_images):
+        return False
+    if split:
+        volumes = builder.plan_volumes(volume_max_bytes, volume_max_tables)
+        if len(volumes) > 1:
+            files = builder.build_volumes(file_name, volumes)
+            if files is None:
+                return False
+            if stats_format is not None:
+                builder.statistics.save(stats_path(file_name, stats_format))
+            debug_log(f"请查看 \033[32m{', '.join(files)}\033[m 文件")
+            return True
+    if not builder.build(stream_to=file_name if stream_output else None):
+        return False
+    builder.save(file_name)
+    if stats_format is not None:
+        builder.statistics.save(stats_path(file_name, stats_format))
+    debug_log(f"请查看 \033[32m{file_name}\033[m 文件")
+    return True
 
 
-if __name__ == "__main__":
+# 读取批量任务清单: [{"input": "图片目录", "output": "报告文件"}, ...]
+def load_manifest(manifest_file):
+    """Load (input dir, output file) pairs, relative paths are based on the manifest"""
+    with open(manifest_file, encoding="utf-8") as f:
+        jobs = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    return [
+        (os.path.join(base_dir, job["input"]), os.path.join(base_dir, job["output"]))
+        for job in jobs
+    ]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="根据缺陷图片生成配电线路缺陷检测报告")
+    parser.add_argument("-i", "--input", default=IMAGE_DIR, help="图片目录")
+    parser.add_argument("-t", "--template", default=template_file_name, help="模板文件")
+    parser.add_argument("-o", "--output", help="生成的报告文件, 不指定时提示输入文件名")
+    parser.add_argument(
+        "-m", "--manifest", help="批量任务清单(JSON), 一次生成多份报告, 模板只读取一次"
+    )
+    parser.add_argument(
+        "--template-cache",
+        default=template_cache_dir,
+        help="模板分析结果的缓存目录, 模板不变时跳过解析",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="忽略上次的图片清单, 重新处理所有图片",
+    )
+    parser.add_argument(
+        "--image-cache",
+        default=image_cache_dir,
+        help="多份报告共用的图片缓存目录, 相同的图片只处理一次",
+    )
+    parser.add_argument(
+        "--image-cache-size",
+        type=int,
+        default=image_cache_size >> 20,
+        help="图片缓存容量(MB), 超出时删除最久未使用的图片, 0表示不限制",
+    )
+    parser.add_argument(
+        "--bug-types",
+        help="缺陷类别配置文件(JSON), 补充缺陷描述和模糊匹配关键字",
+    )
+    parser.add_argument(
+        "--stats", choices=["json", "csv"], help="同时导出缺陷统计(缺陷类别 x 缺陷等级)"
+    )
+    parser.add_argument(
+        "--stats-only", action="store_true", help="只导出缺陷统计, 不处理图片, 不生成报告"
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=render_shards,
+        help="明细表渲染进程数, 缺陷很多时使用多个进程渲染明细表",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=worker_num, help="图片处理并发数, 0表示CPU核数"
+    )
+    parser.add_argument(
+        "-q", "--quality", type=int, default=image_quality, help="插入图片的JPEG压缩质量"
+    )
+    parser.add_argument(
+        "--draft",
+        nargs="?",
+        const="thumbnail",
+        choices=["thumbnail", "none"],
+        help="草稿模式: 只插入缩略图(none: 插入占位图片), 快速检查编号和统计, 保存为 <报告名>_草稿.docx",
+    )
+    parser.add_argument(
+        "--volume-size",
+        type=int,
+        default=volume_max_bytes >> 20,
+        help="分册: 每册图片的大小上限(MB), 超出时分为 <报告名>_part1.docx, _part2.docx ...",
+    )
+    parser.add_argument(
+        "--volume-tables",
+        type=int,
+        default=volume_max_tables,
+        help="分册: 每册明细表的数量上限",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="保存各阶段耗时和计数 <报告名>_trace.json (Chrome trace 格式)",
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="用 cProfile 分析, 结果保存为 <报告名>.prof"
+    )
+    parser.add_argument(
+        "--tracemalloc", action="store_true", help="记录内存分配, 输出峰值和分配最多的代码行"
+    )
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("--quiet", action="store_true", help="只输出错误信息")
+    verbosity.add_argument("-v", "--verbose", action="store_true", help="输出全部提示信息")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    global debug, warn, worker_num, image_quality, image_cache_dir, image_cache_size
+    global render_shards, save_trace, profile_cpu, profile_memory
+    global volume_max_bytes, volume_max_tables
+    args = parse_args(argv)
+    if args.quiet:
+        debug = warn = False
+    elif args.verbose:
+        debug = warn = True
+    worker_num = args.workers
+    render_shards = args.shards
+    save_trace = args.trace
+    volume_max_bytes = args.volume_size << 20
+    volume_max_tables = args.volume_tables
+    profile_cpu = args.profile
+    profile_memory = args.tracemalloc
+    image_quality = args.quality
+    template_cache.cache_dir = args.template_cache
+    image_cache_dir = args.image_cache
+    image_cache_size = args.image_cache_size << 20
+    if args.bug_types:
+        bug_classifier.load(args.bug_types)
     debug_log("程序开始运行...")
-    main()
+
+    if args.manifest:
+        jobs = load_manifest(args.manifest)
+    else:
+        file_name = args.output
+        if file_name is None:
+            debug_log(
+                f"请确认要处理的文件在\033[32m{os.path.abspath(args.input)}\033[m目录下",
+                1,
+            )
+            # 交互运行时提示输入文件名, 无人值守运行时直接使用默认值
+            tmp_name = "res"
+            if sys.stdin.isatty():
+                tmp_name = timer_input(
+                    "\033[32m待生成的文件名称(按回车确认,ctrl+c取消):\033[m",
+                    default="res",
+                )
+            file_name = f"{tmp_name}.docx"
+        jobs = [(args.input, file_name)]
+
+    with open(args.template, "rb") as f:
+        template_data = f.read()
+    failed = 0
+    for image_dir, file_name in jobs:
+        # 一份报告出错时记录下来, 继续生成下一份
+        try:
+            done = run_report(
+                image_dir,
+                file_name,
+                template_data,
+                not args.full,
+                args.stats,
+                args.stats_only,
+                args.draft,
+            )
+        except Exception:
+            debug_log(f"生成 {file_name} 出错:\n{traceback.format_exc()}", 2)
+            done = False
+        if not done:
+            debug_log(f"生成 {file_name} 失败", 2)
+            failed += 1
+    if len(jobs) > 1:
+        debug_log(f"共{len(jobs)}份报告, 成功{len(jobs) - failed}份")
     debug_log(f"程序运行结束！")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())